@@ -4,6 +4,7 @@ smtp_username = "YOUR RPi's EMAIL ADDRESS" # This is the username used to login
 smtp_password = "YOUR RPi's EMAIL PASSWORD" # This is the password used to login to your SMTP provider
 smtp_host = "smtp.gmail.com" # This is the host of the SMTP provider - change if your RPi is not using a gmail account
 smtp_port = 587 # This is the port that your SMTP provider uses
+smtp_timeout = 30 # Number of seconds to wait on the SMTP server before giving up
 
 sender = "YOUR RPi's EMAIL ADDRESS"
 receiver = ["THE PHONE NUMBER WHERE YOU WANT TO RECEIVE TEXT ALERTS"] # must be a list
@@ -24,7 +25,7 @@ Subject: %s
 
 def send_email():
     try:
-        server = smtplib.SMTP(smtp_host, smtp_port)
+        server = smtplib.SMTP(smtp_host, smtp_port, timeout=smtp_timeout)
         # identify ourselves to smtp gmail client
         server.ehlo()
         # secure our email with tls encryption
@@ -34,5 +35,5 @@ def send_email():
         server.login(smtp_username, smtp_password) # If you don't need to login to your smtp provider, simply remove this line
         server.sendmail(sender, receiver, message)         
         print("Successfully sent email")
-    except smtplib.SMTPException:
+    except (smtplib.SMTPException, OSError): #OSError covers no network, DNS failures and timeouts
         print("Error: unable to send email")
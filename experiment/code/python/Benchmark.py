@@ -0,0 +1,64 @@
+import cProfile
+import datetime
+import pstats
+import time
+import Devices as dev
+import IO_ctrl as io
+import MHWsim as sim
+import PID
+import SensorAverage as savg
+import SensorInfo as sinfo
+import SimDevices as sdev
+import Temperature as tm
+
+#Benchmark settings
+sweeps = 1 #number of get_avg_temp calls timed for each setting
+profile_rows = 20 #number of functions listed in the tick profile
+
+def make_probes(resolution=None): #TEMP for every probe on the simulated bus, None = resolution from SensorInfo
+    return [tm.TEMP(device_folder, resolution) for device_folder in sorted(dev.w1.find('28*'))]
+
+def time_sweep(temp_ctrl, mode):
+    savg.acquisition_mode = mode
+    tic = time.perf_counter()
+    for sweep in range(sweeps):
+        savg.get_avg_temp(temp_ctrl, 0)
+    return (time.perf_counter() - tic) / sweeps
+
+def resolution_tradeoff(): #sweep time against precision for each resolution, and for the SensorInfo profile
+    savg.sleep_process = 0 #only time the probes themselves
+    results = []
+    for resolution in [9, 10, 11, 12, None]:
+        w1, gpio = sdev.use_simulator()
+        savg.bus = None #find the simulated bus master
+        temp_ctrl = make_probes(resolution)
+        label = f"{resolution} bit" if resolution is not None else "SensorInfo"
+        steps = sorted(set(sinfo.resolution_step[ctrl.Resolution] for ctrl in temp_ctrl))
+        results.append([label, steps, savg.sweep_budget(temp_ctrl), time_sweep(temp_ctrl, "serial"), time_sweep(temp_ctrl, "parallel"), time_sweep(temp_ctrl, "bulk")])
+        w1.cleanup()
+    return results
+
+def profile_tick(**options): #profile one control tick of mhw_sim on the simulated bus, options go to SimDevices.SIMW1
+    w1, gpio = sdev.use_simulator(heater_pins=sim.heater_pins, **options)
+    savg.bus = None
+    temp_ctrl = sim.find_probes()
+    io_inst = io.IO_CTRL(sim.heater_pins)
+    temp_set = [15, 15, 15]
+    profiler = cProfile.Profile()
+    profiler.enable()
+    phase = sim.get_phase(datetime.datetime.today())
+    diff_sump, Kp, Ki, Kd = sim.phase_gains(phase)
+    temp_sets = sim.get_set_points(phase, temp_set, time.perf_counter())
+    avg_temps_all, avg_temps, sump_temps = savg.get_avg_temp(temp_ctrl, sim.sleep_repeat)
+    pid_out = PID.PID(Kp, Ki, Kd).update(temp_sets, sump_temps).tolist()
+    sim.set_heaters(io_inst, phase, pid_out, avg_temps, sump_temps, temp_sets, diff_sump)
+    profiler.disable()
+    w1.cleanup()
+    return pstats.Stats(profiler).sort_stats("cumulative")
+
+if __name__ == "__main__":
+    results = resolution_tradeoff()
+    print("resolution, step (C), parallel budget (s), serial sweep (s), parallel sweep (s), bulk sweep (s)")
+    for label, steps, budget, serial_time, parallel_time, bulk_time in results:
+        print(f"{label}, {'/'.join(str(step) for step in steps)}, {round(budget,3)}, {round(serial_time,3)}, {round(parallel_time,3)}, {round(bulk_time,3)}")
+    profile_tick(crc_failure_rate=0.05, dead_probes=[sinfo.chill_devices[0]]).print_stats(profile_rows)
@@ -0,0 +1,29 @@
+import json
+import os
+import time
+
+#Initialize checkpoint parameters
+checkpoint_file = "./local/checkpoint.json" #control state written every tick, read back when mhw_sim restarts
+max_age = 6*60*60 #number of seconds after which the PID and heater state are too old to resume from, the phase and ramp start never expire
+version = 1 #bumped when the saved fields change, older checkpoints are ignored
+
+def save(state, file_name=checkpoint_file): #write state atomically, a crash mid-write leaves the last checkpoint in place
+    state = dict(state, version=version, saved=time.time())
+    os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True) #./local/ doesn't exist on a fresh card
+    temp_name = file_name + ".tmp"
+    with open(temp_name, 'w') as f:
+        json.dump(state, f, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_name, file_name)
+
+def load(file_name=checkpoint_file): #last saved state, None if there is none or it is corrupt or from another version, "stale" is set once it is older than max_age
+    try:
+        with open(file_name) as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if not isinstance(state, dict) or state.get("version") != version:
+        return None
+    state["stale"] = time.time() - state.get("saved", 0) > max_age
+    return state
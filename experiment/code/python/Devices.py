@@ -0,0 +1,39 @@
+import glob
+import os
+
+class W1(object): #1-Wire sysfs access, SimDevices swaps in a simulated bus
+    def __init__(self, base_dir='/sys/bus/w1/devices/'):
+        self.base_dir = base_dir #directory where thermistor and bus master files are populated
+
+    def find(self, pattern): #device or bus master paths matching pattern under base_dir
+        return glob.glob(self.base_dir + pattern)
+
+    def exists(self, path):
+        return os.path.exists(path)
+
+    def open(self, path): #file descriptor kept open by the probe between reads
+        return os.open(path, os.O_RDONLY)
+
+    def read_into(self, fd, views, path): #read the whole file into views, reading from offset 0 makes sysfs produce a fresh value
+        return os.preadv(fd, views, 0)
+
+    def close(self, fd):
+        os.close(fd)
+
+    def read(self, path):
+        with open(path, 'r') as f:
+            return f.read()
+
+    def write(self, path, text):
+        with open(path, 'w') as f:
+            f.write(text)
+
+w1 = W1() #1-Wire backend used by Temperature, Memory and MHWsim
+GPIO = None #GPIO backend used by IO_ctrl, RPi.GPIO unless a simulated one is set
+
+def get_gpio():
+    global GPIO
+    if GPIO is None:
+        import RPi.GPIO #only on the Pi, so the simulator can run without it
+        GPIO = RPi.GPIO
+    return GPIO
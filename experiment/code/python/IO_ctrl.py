@@ -1,23 +1,97 @@
-import RPi.GPIO as GPIO
+import threading
+import time
+import Devices as dev
 
-heater_on = GPIO.HIGH
-heater_off = GPIO.LOW
+heater_on = 1 #GPIO.HIGH
+heater_off = 0 #GPIO.LOW
+min_switch = 2 #shortest number of seconds a heater is left on or off in time-proportioning mode, so relays don't chatter
 
 class IO_CTRL(object):
     def __init__(self, heater_pins):
         self.heater_pins = heater_pins
-        self.heater_states = [0] * len(heater_pins)
+        self.heater_states = [0] * len(heater_pins) #intended state of each heater, applied to the pins by commit()
+        self.pin_states = [0] * len(heater_pins) #state last written to each pin
+        self.switch_counts = [0] * len(heater_pins) #number of times each pin has changed state
+        self.switch_times = [None] * len(heater_pins) #time.time() of each pin's last change
+        self.duties = [0] * len(heater_pins) #fraction of each window a heater is on in time-proportioning mode
+        self.window = 0 #number of seconds in each time-proportioning window
+        self.lock = threading.RLock() #the duty thread and the control tick both switch pins
+        self.duty_event = threading.Event() #set when new duties arrive or the duty thread should stop
+        self.duty_stop = False
+        self.duty_thread = None
+        self.GPIO = dev.get_gpio() #RPi.GPIO on the Pi, or the simulated GPIO
 
-        GPIO.setwarnings(False)
-        GPIO.setmode(GPIO.BCM)       
-        GPIO.setup(self.heater_pins, GPIO.OUT, initial=heater_off) #setup the heater pins as outputs and initalize them as low
+        self.GPIO.setwarnings(False)
+        self.GPIO.setmode(self.GPIO.BCM)       
+        self.GPIO.setup(self.heater_pins, self.GPIO.OUT, initial=heater_off) #setup the heater pins as outputs and initalize them as low
 
-    def heat(self, tank_num, heater_state): #turn on associated heater
-        if heater_state:
-            GPIO.output(self.heater_pins[tank_num], heater_on)
+    def stage(self, tank_num, heater_state): #set the intended state, the pin changes on the next commit()
+        self.heater_states[tank_num] = 1 if heater_state else 0
+
+    def commit(self, force=False): #write every pin whose intended state changed in one GPIO call, force rewrites them all
+        with self.lock:
+            changed = [index for index, state in enumerate(self.heater_states) if force or state != self.pin_states[index]]
+            if not changed:
+                return changed
+            self.GPIO.output([self.heater_pins[index] for index in changed], [heater_on if self.heater_states[index] else heater_off for index in changed])
+            now = time.time()
+            for index in changed:
+                if self.heater_states[index] != self.pin_states[index]:
+                    self.switch_counts[index] += 1
+                    self.switch_times[index] = now
+                self.pin_states[index] = self.heater_states[index]
+            return changed
+
+    def heat(self, tank_num, heater_state): #turn on associated heater right away
+        self.stage(tank_num, heater_state)
+        self.commit()
+
+    def set_duty(self, duties, window): #time-proportioning: heater i is on for the first duties[i] of every window seconds, starting now
+        with self.lock:
+            self.duties = [clip_duty(duty, window) for duty in duties]
+            self.window = window
+        if self.duty_thread is None:
+            self.duty_stop = False
+            self.duty_thread = threading.Thread(target=self.run_duty, name="duty cycle", daemon=True)
+            self.duty_thread.start()
         else:
-            GPIO.output(self.heater_pins[tank_num], heater_off)
-        self.heater_states[tank_num] = heater_state
+            self.duty_event.set() #start a new window with the new duties
+        return self.duties
+
+    def run_duty(self): #switch every heater on at the start of a window and off once its share of the window is up
+        while not self.duty_stop:
+            self.duty_event.clear()
+            with self.lock:
+                duties, window = list(self.duties), self.window
+                for index, duty in enumerate(duties):
+                    self.stage(index, duty > 0)
+                self.commit()
+            window_start = time.monotonic()
+            interrupted = False
+            for off_time, index in sorted((window_start + duty * window, index) for index, duty in enumerate(duties) if 0 < duty < 1):
+                if self.duty_event.wait(off_time - time.monotonic()):
+                    interrupted = True
+                    break
+                self.heat(index, 0)
+            if not interrupted:
+                self.duty_event.wait(window_start + window - time.monotonic())
+
+    def stop_duty(self): #stop time-proportioning, the heaters stay as they are until switched
+        if self.duty_thread is not None:
+            self.duty_stop = True
+            self.duty_event.set()
+            if self.duty_thread is not threading.current_thread():
+                self.duty_thread.join()
+            self.duty_thread = None
 
     def cleanup(self): #cleanup
-        GPIO.cleanup()
+        self.stop_duty()
+        self.GPIO.cleanup()
+
+def clip_duty(duty, window): #fraction of the window between 0 and 1, on or off times shorter than min_switch are dropped
+    duty = min(max(duty, 0), 1)
+    if duty * window < min_switch:
+        return 0
+    if (1 - duty) * window < min_switch:
+        return 1
+    return duty
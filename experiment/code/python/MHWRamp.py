@@ -1,4 +1,5 @@
 import time
+import numpy as np
 
 sec_per_day = 24*60*60 
 onset_rate = 0.51/sec_per_day
@@ -14,4 +15,10 @@ def ramp_down(delta_max, start_ramp):
     delta = delta_max - (time.perf_counter()-start_ramp)*decline_rate
     if delta<0:
         delta = 0
-    return delta
\ No newline at end of file
+    return delta
+
+def ramp_up_since(delta_max, seconds): #ramp_up for an array of seconds since the ramp started
+    return np.clip(np.asarray(seconds)*onset_rate, 0, delta_max)
+
+def ramp_down_since(delta_max, seconds): #ramp_down for an array of seconds since the ramp started
+    return np.clip(delta_max - np.asarray(seconds)*decline_rate, 0, delta_max)
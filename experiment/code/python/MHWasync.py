@@ -0,0 +1,133 @@
+import asyncio
+import datetime
+import time
+import Alert
+import IO_ctrl as io
+import Memory as mem
+import MHWsim as sim
+import PID
+import Schedule as sched
+import Sampler as smp
+import SensorAverage as savg
+import Temperature as tm
+import Ticker as tk
+
+async def read_sweep_async(temp_ctrl, bus, sweep_end): #like SensorAverage.read_sweep, but waits for the conversion without blocking the loop
+    converted = False
+    if bus.Triggers:
+        try:
+            bus.trigger()
+            await asyncio.sleep(tm.bus_conversion_time()) #every probe on the bus converts, not just this group
+            while bus.pending() and time.perf_counter() < sweep_end:
+                await asyncio.sleep(tm.bulk_poll)
+            converted = not bus.pending()
+        except OSError:
+            print("bulk conversion failed")
+    raw_temps = []
+    for ctrl in temp_ctrl:
+        if time.perf_counter() + savg.read_overhead > sweep_end: #no time left to read this probe
+            raw_temps.append(tm.missing)
+            continue
+        if converted:
+            raw_temps.append(ctrl.load_converted(sweep_end))
+            await asyncio.sleep(0) #let the control tick run between probes
+        else: #per-probe conversion and CRC retries block for up to a second, so they run off the loop
+            raw_temps.append(await asyncio.to_thread(ctrl.load_temp, sweep_end))
+    return raw_temps
+
+async def sample_loop(sampler, bus): #fills the sampler's ring instead of its thread
+    loop = asyncio.get_running_loop()
+    next_sweep = loop.time()
+    while True:
+        sweep_start = time.perf_counter()
+        sampler.record(await read_sweep_async(sampler.temp_ctrl, bus, sweep_start + min(sampler.period, savg.sweep_timeout)), sweep_start)
+        next_sweep += sampler.period
+        if next_sweep < loop.time(): #sweep ran long, start the next one now instead of catching up
+            next_sweep = loop.time()
+        await asyncio.sleep(next_sweep - loop.time())
+
+async def alert_loop(alert_queue):
+    while True:
+        await alert_queue.get()
+        try: #smtplib blocks, so it runs on a worker thread, and a failed alert never stops control
+            await asyncio.wait_for(asyncio.to_thread(Alert.send_email), Alert.smtp_timeout * 2)
+        except Exception as error:
+            print(f"Alert not sent: {error!r}")
+
+async def control_loop(temp_profile, schedule, sampler, io_inst, m):
+    #initalize PID loops, one per sump tank
+    pid = PID.PID(*sim.phase_gains("pre")[1:])
+
+    today = datetime.datetime.today() #date and time for today
+    phase, start_ramp = sim.restore_checkpoint(pid, io_inst) #carry on from before a crash
+
+    ticker = tk.TICKER(sim.tick_period)
+    while True:
+        await asyncio.sleep(ticker.delay()) #the loop clock is monotonic too, so this wakes at the ticker's deadline
+        current_datetime = ticker.tick() #wall-clock date and time of this tick
+        print(f"Tick started {round(ticker.Lateness, 4)} seconds late")
+        if sim.get_phase(today) != phase: #start the ramp over at the start of the MHW and of the recovery period
+            phase = sim.get_phase(today)
+            start_ramp = time.perf_counter()
+            m.flush() #make sure the rows from the last phase are on the card
+        diff_sump, Kp, Ki, Kd = sim.phase_gains(phase)
+        if schedule is not None:
+            temp_set, temp_sets = sched.set_points(schedule, current_datetime) #profile row and ramped set points for this tick
+        else:
+            temp_set = temp_profile.lookup(current_datetime, sim.interpolate_profile) #Extract the temperature values for the current date and time
+            temp_sets = sim.get_set_points(phase, temp_set, start_ramp)
+        print(f"The current temperature set points are: {temp_set}")
+        avg_temps_all, avg_temps, sump_temps = sampler.get_avg_temp()
+        pid.set_gains(Kp, Ki, Kd)
+        pid_out = pid.update(temp_sets, sump_temps).tolist()
+        print(f"sump temps are {sump_temps}")
+        print(f"PID outputs are {pid_out}")
+        heater_status = sim.update_heaters(io_inst, phase, pid_out, avg_temps, sump_temps, temp_sets, diff_sump)
+        m.save(temp_set + heater_status + avg_temps_all, current_datetime, timeout=0) #the CSV is written by the LOGGER thread, never wait on it in the loop
+        sim.save_checkpoint(pid, phase, start_ramp, io_inst)
+        today = datetime.datetime.today() #check the current date
+
+async def run_until_failure(tasks, control): #run the control loop, but stop if a background task dies
+    control_task = asyncio.create_task(control)
+    done, pending = await asyncio.wait(tasks + [control_task], return_when=asyncio.FIRST_EXCEPTION)
+    for task in done:
+        task.result() #raise the error so main.py restarts the simulator
+    control_task.cancel()
+
+async def mhw_sim_async():
+    temp_profile = sim.load_profile()
+    schedule = sim.compile_schedule(temp_profile, datetime.datetime.now()) if sim.precompile_schedule else None
+
+    m = mem.LOGGER(mem.open_sinks("./local/","./external/")) #storage locations on RPi, written by a background thread
+
+    temp_ctrl = sim.find_probes()
+    sampler = smp.MULTISAMPLER(temp_ctrl) if sim.multi_rate_sampling else smp.SAMPLER(temp_ctrl) #only the rings are used, sample_loop fills them
+    samplers = sampler.Samplers if sim.multi_rate_sampling else [sampler]
+    bus = tm.BUS()
+
+    io_inst = io.IO_CTRL(sim.heater_pins)
+    sim.heaters_off(io_inst)
+
+    alert_queue = asyncio.Queue(1)
+    def queue_alert(): #Temperature alerts go through the loop instead of a new thread
+        if not alert_queue.full():
+            alert_queue.put_nowait(True)
+    alert_hook, tm.alert_hook = tm.alert_hook, queue_alert
+
+    tasks = [asyncio.create_task(sample_loop(group_sampler, bus)) for group_sampler in samplers] + [asyncio.create_task(alert_loop(alert_queue))]
+    try:
+        sweep_end = time.perf_counter() + savg.sweep_timeout
+        while sampler.Count == 0 and time.perf_counter() < sweep_end: #make sure the first tick has readings
+            await asyncio.sleep(0.05)
+        await run_until_failure(tasks, control_loop(temp_profile, schedule, sampler, io_inst, m))
+    finally:
+        for task in tasks:
+            task.cancel()
+        tm.alert_hook = alert_hook
+        m.close() #write out the queued and buffered rows
+        #Finish the experiment (or crash), turn everything off!
+        sim.heaters_off(io_inst)
+        io_inst.cleanup() #cleanup
+
+def mhw_sim():
+    asyncio.run(mhw_sim_async())
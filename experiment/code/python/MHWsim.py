@@ -1,204 +1,232 @@
-import glob
 import time
 import datetime
-import pandas as pd
 import Temperature as tm
+import Devices as dev
 import IO_ctrl as io
 import Memory as mem
 import MHWRamp as mhwr
 import SensorAverage as savg
+import Sampler as smp
 import SensorInfo as sinfo
-import CleanUp as clean
+import Ticker as tk
 import PID
+import Profile as prof
+import Checkpoint as ckpt
+import Schedule as sched
 
-def mhw_sim():
-    # Read the CSV file and convert to dictionary
-    temp_profile = pd.read_csv("mhw_profile.csv", skiprows=1, usecols=[0,1,2,3], names=["datetime", "severe", "extreme", "chill"])
-    temp_profile["datetime"] = temp_profile["datetime"].apply(lambda x: pd.to_datetime(x) + pd.Timedelta(days=365.25 * 8)) #convert datetime column to dates and times, then add 8 years to make it 2023/2024
-    temp_profile["datetime"] = temp_profile["datetime"].dt.tz_localize(None) #Remove the timezone from datetime
-    temp_profile = dict([(i,[x,y,z]) for i,x,y,z in zip(temp_profile["datetime"], temp_profile["chill"], temp_profile["severe"],temp_profile["extreme"])])
+#Initialize MHW parameters
+severe_thresh = 4 #initialize severe MHW parameter
+extreme_thresh = 8 #initialize extreme MHW parameter
+mhw_date = datetime.datetime(2023, 10, 2) #date of start of MHW (42 DAYS LONG)
+post_mhw = datetime.datetime(2023, 11, 13) #date of start of recovery period
+
+#Initialize heater pins
+heater_pins = [26, 20, 21] #20=LED2, #21=LED3, #26=LED1
+
+#initalize PID parameters
+pid_value = 0 #initialize PID output threshold parameter
+fo = (1/40) #calculated frequency of oscillation for my sump tanks
+
+sleep_repeat = 0.1 #number of seconds to sleep between repeated temperature measurements
+tick_period = 30 #number of seconds between control ticks, lined up with the :00 and :30 marks (15 in MHWpublication)
+background_sampling = True #read the probes on a background thread so the control tick only takes a snapshot
+multi_rate_sampling = True #sweep each SensorInfo sample group at its own rate (sump probes often, replicate tanks rarely)
+interpolate_profile = False #interpolate set points between profile rows instead of using the closest row
+precompile_schedule = True #compile every tick's set points at startup instead of working them out each tick
+time_proportional = False #turn each PID output into a share of the tick the heater is on, instead of on or off for the whole tick
+duty_span = 1 #PID output that keeps a heater on for the whole tick in time-proportioning mode
 
-    m = mem.MEM("./local/","./external/") #storage locations on RPi
+def load_profile(file_name="mhw_profile.csv"):
+    #Compiled [chill, severe, extreme] profile, dates moved 8 years to make it 2023/2024 and timezone removed, the CSV is only parsed again when it changes
+    return prof.load(file_name, offset_days=365.25 * 8, columns=(3, 1, 2))
 
+def find_probes():
     #Initialize temperature sensors
-    base_dir = '/sys/bus/w1/devices/'            #directory where thermistor files are populated
-    device_folders = glob.glob(base_dir + '28*') #get list of all thermistor folders
+    device_folders = dev.w1.find('28*') #get list of all thermistor folders
     temp_ctrl = []                               #create empty list that we will populate with thermistor controllers
     num_therm = len(device_folders)              #calculate the number of thermistor pairs
     print(f"The number of thermistors detected by RPi: {num_therm}")
     for index_num in range(num_therm):                   #loop through each pair
         ctrl = tm.TEMP(device_folders[index_num])        #create thermistor controller for a single pair
         temp_ctrl.append(ctrl)                   #add that thermistor controller to the list
+    return temp_ctrl
 
-    #Initialize variables and lists
-    chill_set, severe_set, extreme_set = [0 for i in range(3)] #initialize variables set to zero
-    temp_set, heater_status, sump_temps = ([] for i in range(3)) #initialize blank list for treatment temperature set points and heater statuses
- 
-    #initalize PID parameters
-    pid_value = 0 #initialize PID output threshold parameter
-    error_integral = [0,0,0] #initialize error integral values
-    error_derivative = [0,0,0] #initialize error derivative values
-    previous_temps = [15, 15, 15] #arbitrary, will be changed immediately after first loop
-    fo = (1/40) #calculated frequency of oscillation for my sump tanks
- 
-    sleep_repeat = 0.1 #number of seconds to sleep between repeated temperature measurements
-    #Initialize MHW parameters
-    severe_thresh = 4 #initialize severe MHW parameter
-    extreme_thresh = 8 #initialize extreme MHW parameter
-    today = datetime.datetime.today() #date and time for today
-    mhw_date = datetime.datetime(2023, 10, 2) #date of start of MHW (42 DAYS LONG)
-    post_mhw = datetime.datetime(2023, 11, 13) #date of start of recovery period 
-
-    #Initialize heater pins
-    heater_pins = [26, 20, 21] #20=LED2, #21=LED3, #26=LED1
-    io_inst = io.IO_CTRL(heater_pins)
+def get_phase(today): #"pre" before the MHW, "mhw" during the onset and peak, "post" during recovery
+    if today < mhw_date:
+        return "pre"
+    if today < post_mhw:
+        return "mhw"
+    return "post"
 
-    # Initialize heaters to off in all tanks
-    heater_state = 0
-    for heater_pin in range(len(heater_pins)):
-        io_inst.heat(heater_pin, heater_state)
-        print(f"Sump tank {heater_pin} heater OFF")
-
-######################################## MHW SIM TIME
-    while today < mhw_date:
-        current_datetime = datetime.datetime.now() #Read the current date and time
+def phase_gains(phase): #diff_sump, Kp, Ki, Kd for each phase
+    if phase == "pre":
         diff_sump = [1, 1, 1] #minimum temperature in sump tank to force kick back on heater
         Kp = [0.5,0.5,0.5] #proportional gain, determines how fast the system responds
         Ki = [0,0,0] #integral, determines how fast steady-state error is removed
         Kd = [fo/4,fo/4,fo/4] #derivative, determines how far into the future to predict rate of change
-        if current_datetime.second % 30 == 00: #run script on the 30 seconds or 00 seconds mark
-            closest_datetime = min(temp_profile.keys(), key=lambda x: abs(x - current_datetime)) #Find the date/time row in the temperature profile closest to current date and time
-            temp_set = temp_profile[closest_datetime] #Extract the temperature values from the closest date and time
-            print(f"The current temperature set points are: {temp_set}")
-            avg_temps_all, avg_temps, sump_temps = savg.get_avg_temp(temp_ctrl, sleep_repeat)
-            chill_set = temp_set[0]
-            temp_sets = [chill_set,chill_set,chill_set]
-            pid_out, previous_temps, error_integral, error_derivative = PID.control_temps(temp_sets, sump_temps, previous_temps, error_integral, error_derivative, Kp, Ki, Kd)
-            print(f"sump temps are {sump_temps}")
-            print(f"PID outputs are {pid_out}")
-            for index_num in range(len(heater_pins)):
-                if io_inst.heater_states[index_num] == 0: #If tank heater is off
-                    if pid_out[index_num] > pid_value and avg_temps[index_num] < chill_set:
-                        io_inst.heat(index_num, 1)
-                        print(f"Sump tank {index_num} heater ON")
-                        heater_status.append("on")
-                    else:
-                        io_inst.heat(index_num, 0)
-                        print(f"Sump tank {index_num} heater too hot, heater OFF")
-                        heater_status.append("off")
-                else: #If tank heater is on
-                    if pid_out[index_num] > pid_value and avg_temps[index_num] < chill_set: #if sump tank is stable and experimental tanks are too cold
-                        io_inst.heat(index_num, 1)
-                        print(f"Sump tank {index_num} heater staying on")
-                        heater_status.append("on")
-                    else:
-                        io_inst.heat(index_num, 0)
-                        print(f"Sump tank {index_num} heater turning off")
-                        heater_status.append("off")
-            sump_temps, avg_temps_all, heater_status, today = clean.save_and_sleep(m, temp_set, heater_status, avg_temps_all, sump_temps) 
-        else:
-            time.sleep(sleep_repeat)
-####################################
-    start_ramp = time.perf_counter()
-    while today < post_mhw:
-        current_datetime = datetime.datetime.now() #Read the current date and time
-        diff_sump = [1, 0.75, 0.5] #minimum temperature in sump tank to force kick back on heater
-        Kp = [0.5,1,64] #proportional gain, determines how fast the system responds
-        Ki = [0,0,0] #integral, determines how fast steady-state error is removed
-        Kd = [fo/4,fo/4,fo/8] #derivative, determines how far into the future to predict rate of change
-        if current_datetime.second % 30 == 00: #run script on the 30 seconds or 00 seconds mark
-            closest_datetime = min(temp_profile.keys(), key=lambda x: abs(x - current_datetime)) #Find the date/time row in the temperature profile closest to current date and time
-            temp_set = temp_profile[closest_datetime] #Extract the temperature values from the closest date and time
-            print(f"The current temperature set points are: {temp_set}")
-            delta_severe = mhwr.ramp_up(severe_thresh, start_ramp)
-            delta_extreme = mhwr.ramp_up(extreme_thresh, start_ramp)
-            avg_temps_all, avg_temps, sump_temps = savg.get_avg_temp(temp_ctrl, sleep_repeat)
-            chill_set = temp_set[0]
-            severe_set = temp_set[0] + delta_severe    
-            extreme_set = temp_set[0] + delta_extreme
-            temp_sets = [chill_set, severe_set, extreme_set]
-            pid_out, previous_temps, error_integral, error_derivative = PID.control_temps(temp_sets, sump_temps, previous_temps, error_integral, error_derivative, Kp, Ki, Kd)
-            print(f"sump temps are {sump_temps}")
-            print(f"PID outputs are {pid_out}")
-            for index_num in range(len(heater_pins)):
-                if io_inst.heater_states[index_num] == 0: #If tank heater is off
-                    if pid_out[index_num] > pid_value and avg_temps[index_num] < temp_sets[index_num]: #if sump tank is warming and experimental tanks are not warm enough
-                        io_inst.heat(index_num, 1)
-                        print(f"Sump tank {index_num} heater ON")
-                        heater_status.append("on") 
-                    elif temp_sets[index_num] - sump_temps[index_num] > diff_sump[index_num]: #if sump tank is way too cold
-                        io_inst.heat(index_num, 1)
-                        print(f"Sump tank {index_num} too cold, heater ON")
-                        heater_status.append("on")
-                    else:
-                        io_inst.heat(index_num, 0)
-                        print(f"Sump tank {index_num} heater too hot")
-                        heater_status.append("off")
-                else: #If tank heater is on
-                    if pid_out[index_num] > pid_value and avg_temps[index_num] < temp_sets[index_num]: #if sump tank is stable and experimental tanks are too cold
-                        io_inst.heat(index_num, 1)
-                        print(f"Sump tank {index_num} heater staying on")
-                        heater_status.append("on")
-                    else:
-                        io_inst.heat(index_num, 0)
-                        print(f"Sump tank {index_num} heater turning off")
-                        heater_status.append("off")
-            sump_temps, avg_temps_all, heater_status, today = clean.save_and_sleep(m, temp_set, heater_status, avg_temps_all, sump_temps)                    
-        else:
-            time.sleep(sleep_repeat)
-####################################
-    start_ramp = time.perf_counter()
-    while today >= post_mhw:
-        current_datetime = datetime.datetime.now() #Read the current date and time
+    else:
         diff_sump = [1, 0.75, 0.5] #minimum temperature in sump tank to force kick back on heater
         Kp = [0.5,1,64] #proportional gain, determines how fast the system responds
         Ki = [0,0,0] #integral, determines how fast steady-state error is removed
         Kd = [fo/4,fo/4,fo/8] #derivative, determines how far into the future to predict rate of change
-        if current_datetime.second % 30 == 00: #run script on the 30 seconds or 00 seconds mark
-            closest_datetime = min(temp_profile.keys(), key=lambda x: abs(x - current_datetime)) #Find the date/time row in the temperature profile closest to current date and time
-            temp_set = temp_profile[closest_datetime] #Extract the temperature values from the closest date and time
-            print(f"The current temperature set points are: {temp_set}")
-            delta_severe = mhwr.ramp_down(severe_thresh, start_ramp)
-            delta_extreme = mhwr.ramp_down(extreme_thresh, start_ramp)
-            avg_temps_all, avg_temps, sump_temps = savg.get_avg_temp(temp_ctrl, sleep_repeat)
-            chill_set = temp_set[0]
-            severe_set = temp_set[0] + delta_severe    
-            extreme_set = temp_set[0] + delta_extreme
-            temp_sets = [chill_set, severe_set, extreme_set]
-            pid_out, previous_temps, error_integral, error_derivative = PID.control_temps(temp_sets, sump_temps, previous_temps, error_integral, error_derivative, Kp, Ki, Kd)
-            print(f"sump temps are {sump_temps}")
-            print(f"PID outputs are {pid_out}")
-            for index_num in range(len(heater_pins)):
-                if io_inst.heater_states[index_num] == 0: #If tank heater is off
-                    if pid_out[index_num] > pid_value and avg_temps[index_num] < temp_sets[index_num]: #if sump tank is warming and experimental tanks are not warm enough
-                        io_inst.heat(index_num, 1)
-                        print(f"Sump tank {index_num} heater ON")
-                        heater_status.append("on") 
-                    #elif temp_sets[index_num] - sump_temps[index_num] > diff_sump[index_num]: #if sump tank is way too cold
-                    #    io_inst.heat(index_num, 1)
-                    #    print(f"Sump tank {index_num} too cold, heater ON")
-                    #    heater_status.append("on")
-                    else:
-                        io_inst.heat(index_num, 0)
-                        print(f"Sump tank {index_num} heater too hot")
-                        heater_status.append("off")
-                else: #If tank heater is on
-                    if pid_out[index_num] > pid_value and avg_temps[index_num] < temp_sets[index_num]: #if sump tank is stable and experimental tanks are too cold
-                        io_inst.heat(index_num, 1)
-                        print(f"Sump tank {index_num} heater staying on")
-                        heater_status.append("on")
-                    else:
-                        io_inst.heat(index_num, 0)
-                        print(f"Sump tank {index_num} heater turning off")
-                        heater_status.append("off")
-            sump_temps, avg_temps_all, heater_status, today = clean.save_and_sleep(m, temp_set, heater_status, avg_temps_all, sump_temps)                    
+    return diff_sump, Kp, Ki, Kd
+
+def get_set_points(phase, temp_set, start_ramp): #chill, severe and extreme set points from the profile row and the ramp
+    chill_set = temp_set[0]
+    if phase == "pre":
+        return [chill_set,chill_set,chill_set]
+    if phase == "mhw":
+        delta_severe = mhwr.ramp_up(severe_thresh, start_ramp)
+        delta_extreme = mhwr.ramp_up(extreme_thresh, start_ramp)
+    else:
+        delta_severe = mhwr.ramp_down(severe_thresh, start_ramp)
+        delta_extreme = mhwr.ramp_down(extreme_thresh, start_ramp)
+    severe_set = temp_set[0] + delta_severe
+    extreme_set = temp_set[0] + delta_extreme
+    return [chill_set, severe_set, extreme_set]
+
+def compile_schedule(temp_profile, start, end=None): #set point schedule from start to the end of the profile, ramps timed from mhw_date and post_mhw
+    if end is None:
+        end = prof.epoch + datetime.timedelta(seconds=float(temp_profile.Times[-1]))
+    return sched.compile_schedule(temp_profile, start, max(start, end), severe_thresh, extreme_thresh, mhw_date, post_mhw, step=tick_period, interpolate=interpolate_profile)
+
+def set_heaters(io_inst, phase, pid_out, avg_temps, sump_temps, temp_sets, diff_sump): #returns the "on"/"off" status of each heater
+    heater_status = []
+    for index_num in range(len(heater_pins)):
+        if io_inst.heater_states[index_num] == 0: #If tank heater is off
+            if pid_out[index_num] > pid_value and avg_temps[index_num] < temp_sets[index_num]: #if sump tank is warming and experimental tanks are not warm enough
+                io_inst.stage(index_num, 1)
+                print(f"Sump tank {index_num} heater ON")
+                heater_status.append("on")
+            elif phase == "mhw" and temp_sets[index_num] - sump_temps[index_num] > diff_sump[index_num]: #if sump tank is way too cold (only during the MHW)
+                io_inst.stage(index_num, 1)
+                print(f"Sump tank {index_num} too cold, heater ON")
+                heater_status.append("on")
+            else:
+                io_inst.stage(index_num, 0)
+                print(f"Sump tank {index_num} heater too hot")
+                heater_status.append("off")
+        else: #If tank heater is on
+            if pid_out[index_num] > pid_value and avg_temps[index_num] < temp_sets[index_num]: #if sump tank is stable and experimental tanks are too cold
+                io_inst.stage(index_num, 1)
+                print(f"Sump tank {index_num} heater staying on")
+                heater_status.append("on")
+            else:
+                io_inst.stage(index_num, 0)
+                print(f"Sump tank {index_num} heater turning off")
+                heater_status.append("off")
+    io_inst.commit() #only the heaters that changed are switched, all in one go
+    return heater_status
+
+def set_heater_duties(io_inst, phase, pid_out, avg_temps, sump_temps, temp_sets, diff_sump): #time-proportioning version of set_heaters
+    duties = []
+    for index_num in range(len(heater_pins)):
+        if phase == "mhw" and temp_sets[index_num] - sump_temps[index_num] > diff_sump[index_num]: #if sump tank is way too cold (only during the MHW)
+            duties.append(1)
+        elif pid_out[index_num] > pid_value and avg_temps[index_num] < temp_sets[index_num]: #if sump tank is warming and experimental tanks are not warm enough
+            duties.append(pid_out[index_num] / duty_span)
         else:
-            time.sleep(sleep_repeat)
+            duties.append(0)
+    duties = io_inst.set_duty(duties, tick_period)
+    for index_num, duty in enumerate(duties):
+        print(f"Sump tank {index_num} heater on for {round(duty * tick_period, 1)} of {tick_period} seconds")
+    return ["on" if duty > 0 else "off" for duty in duties]
 
-    #Finish the experiment, turn everything off!
+def update_heaters(*args): #set_heaters or set_heater_duties, depending on time_proportional
+    return set_heater_duties(*args) if time_proportional else set_heaters(*args)
+
+def heaters_off(io_inst):
+    io_inst.stop_duty()
     heater_state = 0
     for heater_num in range(len(heater_pins)):
-        io_inst.heat(heater_num, heater_state)
-        print(f"Heater {heater_num} TOTALLY OFF")
+        io_inst.stage(heater_num, heater_state)
+        print(f"Sump tank {heater_num} heater OFF")
+    io_inst.commit(force=True) #write every pin, even ones already recorded as off
+
+checkpoint_failed = False #set once a checkpoint can't be written, so the error is only printed once
+
+def save_checkpoint(pid, phase, start_ramp, io_inst): #everything a restart needs to carry on, the ramp start as a wall-clock time
+    global checkpoint_failed
+    try:
+        ckpt.save({"pid": pid.state(), "phase": phase, "ramp_epoch": time.time() - (time.perf_counter() - start_ramp), "heater_states": list(io_inst.heater_states)})
+        checkpoint_failed = False
+    except OSError as error: #full or read-only card, control carries on without a checkpoint
+        if not checkpoint_failed:
+            print(f"Checkpoint not saved, carrying on without one: {error}")
+        checkpoint_failed = True
 
-    io_inst.cleanup() #cleanup
+def restore_checkpoint(pid, io_inst): #(phase, start_ramp) from the last checkpoint, (None, now) when starting fresh
+    state = ckpt.load()
+    if state is None:
+        return None, time.perf_counter()
+    if not state["stale"]: #PID and heaters from hours ago would do more harm than starting them over
+        pid.restore(state["pid"])
+        for heater_num, heater_state in enumerate(state["heater_states"][:len(heater_pins)]):
+            io_inst.stage(heater_num, heater_state)
+        io_inst.commit()
+    print(f"Resumed from checkpoint saved {round(time.time() - state['saved'])} seconds ago, phase {state['phase']}" + (", PID and heaters start over" if state["stale"] else ""))
+    return state["phase"], time.perf_counter() - (time.time() - state["ramp_epoch"]) #ramp keeps its progress across the restart
+
+def mhw_sim():
+    temp_profile = load_profile()
+    schedule = compile_schedule(temp_profile, datetime.datetime.now()) if precompile_schedule else None
+
+    m = mem.LOGGER(mem.open_sinks("./local/","./external/")) #storage locations on RPi, written by a background thread
+
+    temp_ctrl = find_probes()
+
+    #Initialize variables and lists
+    temp_set, heater_status, sump_temps = ([] for i in range(3)) #initialize blank list for treatment temperature set points and heater statuses
+
+    #initalize PID loops, one per sump tank
+    pid = PID.PID(*phase_gains("pre")[1:])
+
+    if background_sampling:
+        sampler = smp.MULTISAMPLER(temp_ctrl) if multi_rate_sampling else smp.SAMPLER(temp_ctrl)
+        sampler.start()
+        sampler.wait_ready(savg.sweep_timeout) #make sure the first tick has readings
+        get_avg_temp = sampler.get_avg_temp
+    else:
+        get_avg_temp = lambda: savg.get_avg_temp(temp_ctrl, sleep_repeat)
+
+    today = datetime.datetime.today() #date and time for today
+
+    #Initialize heater pins
+    io_inst = io.IO_CTRL(heater_pins)
+
+    # Initialize heaters to off in all tanks
+    heaters_off(io_inst)
+    phase, start_ramp = restore_checkpoint(pid, io_inst) #carry on from before a crash
+
+    ticker = tk.TICKER(tick_period)
+    try:
+        while True: #the recovery period runs until the program is stopped
+            current_datetime = ticker.wait() #sleep until the next tick, then use its wall-clock date and time
+            if get_phase(today) != phase: #start the ramp over at the start of the MHW and of the recovery period
+                phase = get_phase(today)
+                start_ramp = time.perf_counter()
+                m.flush() #make sure the rows from the last phase are on the card
+            diff_sump, Kp, Ki, Kd = phase_gains(phase)
+            if schedule is not None:
+                temp_set, temp_sets = sched.set_points(schedule, current_datetime) #profile row and ramped set points for this tick
+            else:
+                temp_set = temp_profile.lookup(current_datetime, interpolate_profile) #Extract the temperature values for the current date and time
+                temp_sets = get_set_points(phase, temp_set, start_ramp)
+            print(f"The current temperature set points are: {temp_set}")
+            avg_temps_all, avg_temps, sump_temps = get_avg_temp()
+            pid.set_gains(Kp, Ki, Kd)
+            pid_out = pid.update(temp_sets, sump_temps).tolist()
+            print(f"sump temps are {sump_temps}")
+            print(f"PID outputs are {pid_out}")
+            heater_status = update_heaters(io_inst, phase, pid_out, avg_temps, sump_temps, temp_sets, diff_sump)
+            m.save(temp_set + heater_status + avg_temps_all, current_datetime) #save data to csv
+            save_checkpoint(pid, phase, start_ramp, io_inst)
+            print(f"Temperatures saved, {ticker.Missed} tick(s) missed so far")
+            today = datetime.datetime.today() #check the current date
+    finally:
+        #Finish the experiment (or crash), turn everything off!
+        heaters_off(io_inst)
+        if background_sampling:
+            sampler.stop() #stop reading the probes
+        io_inst.cleanup() #cleanup
+        m.close() #write out the queued and buffered rows
@@ -1,37 +1,475 @@
-import glob
+import atexit
+import contextlib
 import datetime
+import gzip
+import json
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
 import SensorInfo as sinfo
+import Devices as dev
+import Telemetry as tlm
+import Temperature as tm
+import Profile as prof
+
+#Initialize CSV writer parameters
+file_format = "csv" #"csv" text rows, or "binary" fixed-size Telemetry records (read back with Telemetry.read)
+flush_rows = 10 #number of rows buffered before they are written out, 1 = every row
+flush_seconds = 300 #number of seconds a buffered row may wait before it is written out
+sync_on_flush = True #fsync after every flush so a power cut loses at most the rows still buffered
+buffer_size = 64*1024 #bytes buffered by the open file between flushes
+queue_size = 100 #number of rows that can wait for the writer thread before new rows are dropped
+put_timeout = 0.5 #number of seconds save() waits for space in a full queue before dropping the row
+flush_marker = object() #queued by LOGGER.flush()
+rotate_daily = True #start a new file with the first row of each day
+rotate_bytes = 16*1024*1024 #start a new file once the current one reaches this many bytes
+index_name = "index.json" #sidecar listing every file's time range, format, schema version and row count
+csv_schema_version = 1 #bumped when the CSV columns change
+replicate = True #write to the local path first and copy to the external path in the background, so a missing drive never stalls control
+replicate_seconds = 60 #number of seconds between attempts to copy new rows to the external path
+replicate_timeout = 10 #number of seconds close() waits for the last copy
+#The external path counts as plugged in when it is a mount point, holds external_marker, or is a writable folder.
+#The replicator writes external_marker after its first copy, so an unplugged drive (the empty folder left behind) isn't written to for the rest of the run.
+#Create the marker by hand on a drive that is plugged in, so an empty mount point is never mistaken for the drive after a restart either.
+external_marker = ".mhw_external"
+sqlite_name = None #SQLite database in the local path that also gets every row (e.g. "mhw.sqlite"), None = log files only
+sqlite_treatments = {"chill": sinfo.chill_devices, "severe": sinfo.severe_devices, "extreme": sinfo.extreme_devices, "sump": sinfo.sump_devices} #device columns of each row, in order
+compression = None #None, "gzip", or "zstd" (gzip if zstandard is not installed), each flush is written as one compressed frame
+compression_level = 6 #gzip 1-9, zstd 1-22
+zstd = None #zstandard module, imported the first time it is needed
+
+def get_zstd(): #zstandard if it is installed, else None
+    global zstd
+    if zstd is None:
+        try:
+            import zstandard #optional, only used by compression = "zstd"
+            zstd = zstandard
+        except ImportError:
+            zstd = False
+    return zstd or None
 
 class MEM(object):
-    def __init__(self, device_folder, external_path):
+    def __init__(self, device_folder, external_path, log_format=None):
         self.Probe = device_folder + '/w1_slave'
         self.Name = device_folder.split('/')[-1]
         
-        base_dir = '/sys/bus/w1/devices/'            #directory where thermistor files are populated
-        device_folders = glob.glob(base_dir + '28*') #get list of all thermistor folders
+        device_folders = dev.w1.find('28*') #get list of all thermistor folders
         num_therm = len(device_folders)              #calculate the number of thermistor pairs
         
         self.external_path = external_path
+        self.local_path = device_folder
+        self.log_path = self.local_path if replicate else self.external_path #where rows are written, the external drive only gets copies when replicating
+        self.replicator = REPLICATOR(self.local_path, self.external_path) if replicate else None
+        self.file_format = log_format or file_format #"csv" or "binary", defaults to the module setting
+        self.compression = compression
+        if self.compression == "zstd" and get_zstd() is None:
+            self.compression = "gzip"
+        self.frame = bytearray() #rows waiting to be compressed into the next frame
 
         self.dt = datetime.datetime #use this module for getting the date/time
 
-        self.file_name = str(self.dt.now()) + ".csv" #construct csv file name using datetime so it is always unique
-        self.external_file_name = self.external_path + self.file_name #append to external path
-
-        self.external_file = open(self.external_file_name, 'a');
-        #write header to file
-        header = ["Timestamp", "Chill set", "Severe set", "Extreme set", "Chill heater", "Severe heater", "Extreme heater"]
-        for device_list in [sinfo.chill_devices, sinfo.severe_devices, sinfo.extreme_devices, sinfo.sump_devices]:
-            for device in device_list:
-                header.append(device)
-        self.external_file.write(',' .join(header) + ',' + '\n')
-        self.external_file.close()
-
-    def save(self, data_list):#target_temp, measured_temp):
-        time = self.dt.now() #get date/time data
-        #data = str(time) + ',' + str(target_temp) + ',' + str(measured_temp) + ',' #contruct data point
-        data = str(time) + ',' + ','.join(str(value) for value in data_list) + ','
-        
-        self.external_file = open(self.external_file_name, 'a');
-        self.external_file.write(data + '\n') #write data to external file
-        self.external_file.close()
+        self.formats = {} #number of values: precompiled row format
+        self.pending = 0 #number of rows written since the last flush
+        self.last_flush = time.monotonic()
+        if self.file_format == "csv":
+            #write header to file
+            header = ["Timestamp", "Chill set", "Severe set", "Extreme set", "Chill heater", "Severe heater", "Extreme heater"]
+            for device_list in [sinfo.chill_devices, sinfo.severe_devices, sinfo.extreme_devices, sinfo.sump_devices]:
+                for device in device_list:
+                    header.append(device)
+            self.header = (',' .join(header) + ',' + '\n').encode()
+            self.encode = self.encode_csv
+            self.extension = ".csv" + {None: "", "gzip": ".gz", "zstd": ".zst"}[self.compression]
+            self.schema_version = csv_schema_version
+        else:
+            self.encoder = tlm.ENCODER() #device order comes from SensorInfo and is written in the header
+            self.header = self.encoder.header
+            self.encode = self.encoder.encode
+            self.extension = ".tlm" + {None: "", "gzip": ".gz", "zstd": ".zst"}[self.compression]
+            self.schema_version = tlm.schema_version
+        self.index = load_index(self.log_path)
+        self.log_file = None #opened with the first row, so it is named after that row's time
+        atexit.register(self.close) #rows still buffered are written even if the caller never closes
+
+    def open_file(self, start): #new file named after start, with its own header and index entry
+        base = start.strftime("%Y-%m-%d_%H%M%S") #no spaces or colons, sorts by time
+        self.file_name = base + self.extension
+        copy = 1
+        while os.path.exists(self.log_path + self.file_name): #two files started in the same second
+            self.file_name = f"{base}_{copy}{self.extension}"
+            copy += 1
+        if replicate:
+            os.makedirs(self.log_path, exist_ok=True) #./local/ doesn't exist on a fresh card
+        self.log_file_name = self.log_path + self.file_name #append to local path (or external path without replication)
+        self.log_file = open(self.log_file_name, 'ab', buffering=buffer_size) #kept open, rows are flushed by policy instead of reopening the file every save
+        self.file_bytes = 0
+        self.write(self.header)
+        self.file_day = start.date()
+        self.entry = {"file": self.file_name, "format": self.file_format, "compression": self.compression, "schema_version": self.schema_version, "start": None, "end": None, "rows": 0}
+        self.index["files"].append(self.entry)
+        self.flush()
+
+    def write(self, data): #straight to the file, or into the frame compressed at the next flush
+        if self.compression is None:
+            self.log_file.write(data)
+            self.file_bytes += len(data)
+        else:
+            self.frame += data
+
+    def write_frame(self): #compress the buffered rows as one self-contained gzip member or zstd frame
+        if not self.frame:
+            return
+        if self.compression == "zstd":
+            data = get_zstd().ZstdCompressor(level=compression_level).compress(bytes(self.frame))
+        else:
+            data = gzip.compress(bytes(self.frame), compresslevel=compression_level, mtime=0)
+        self.log_file.write(data)
+        self.file_bytes += len(data)
+        self.frame = bytearray()
+
+    def rotate(self, timestamp): #close the current file and start the next one at timestamp
+        self.flush()
+        self.drop_file()
+        self.open_file(timestamp)
+
+    def drop_file(self): #close the handle, ignoring errors from a dead one, so the next save opens a new file
+        log_file, self.log_file = self.log_file, None
+        self.frame = bytearray() #rows of the dead file that were never written
+        self.pending = 0
+        if log_file is not None:
+            try:
+                log_file.close()
+            except OSError:
+                pass
+
+    def row_format(self, num_values): #"{},{},...,\n" for a timestamp and num_values values, built once per row length
+        row_format = self.formats.get(num_values)
+        if row_format is None:
+            row_format = self.formats[num_values] = "{}," * (num_values + 1) + "\n"
+        return row_format
+
+    def encode_csv(self, data_list, timestamp):
+        return self.row_format(len(data_list)).format(timestamp, *data_list).encode()
+
+    def save(self, data_list, timestamp=None): #buffer one row, timestamp defaults to now
+        if timestamp is None:
+            timestamp = self.dt.now() #get date/time data
+        if self.log_file is None:
+            self.open_file(timestamp)
+        elif (rotate_daily and timestamp.date() != self.file_day) or self.file_bytes >= rotate_bytes:
+            self.rotate(timestamp)
+        try:
+            self.write(self.encode(data_list, timestamp))
+        except OSError: #e.g. the drive was pulled, start a new file with the next row
+            self.drop_file()
+            raise
+        self.entry["start"] = self.entry["start"] or timestamp.isoformat()
+        self.entry["end"] = timestamp.isoformat()
+        self.entry["rows"] += 1
+        self.pending += 1
+        if self.pending >= flush_rows or time.monotonic() - self.last_flush >= flush_seconds:
+            self.flush()
+
+    def flush(self): #write buffered rows to the file (and the card, if sync_on_flush)
+        if self.log_file is None or self.log_file.closed:
+            return
+        try:
+            self.write_frame()
+            self.log_file.flush()
+            if sync_on_flush:
+                os.fsync(self.log_file.fileno())
+            save_index(self.log_path, self.index) #only rows already on disk are counted
+        except OSError: #e.g. the drive was pulled, start a new file with the next row
+            self.drop_file()
+            raise
+        if self.replicator is not None:
+            self.replicator.poke() #copy the new rows to the external drive in the background
+        self.pending = 0
+        self.last_flush = time.monotonic()
+
+    def close(self): #flush and close, safe to call more than once
+        try:
+            self.flush()
+        except OSError: #dead handle, the rows it held are lost either way
+            pass
+        self.drop_file()
+        if self.replicator is not None:
+            self.replicator.stop(replicate_timeout) #last catch-up, rows it can't copy now are copied on the next start
+        atexit.unregister(self.close)
+
+def load_index(path): #{"files": [...]} from the sidecar in path, empty if there is none yet
+    try:
+        with open(path + index_name) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {"files": []}
+
+def save_index(path, index): #replace the sidecar atomically so readers never see half of it
+    temp_name = path + index_name + ".tmp"
+    with open(temp_name, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(temp_name, path + index_name)
+
+def files_between(path, start, end): #names of the files in path with rows between start and end (datetimes), oldest first
+    return [entry["file"] for entry in load_index(path)["files"] if entry["rows"] and entry["start"] <= end.isoformat() and entry["end"] >= start.isoformat()]
+
+class REPLICATOR(object): #copies the new bytes of every indexed local file to the external path, keeping a backlog while it is unavailable
+    def __init__(self, local_path, external_path):
+        self.local_path = local_path
+        self.external_path = external_path
+        self.copied = {} #file name: number of bytes already on the external path
+        self.Available = None #whether the last attempt reached the external path
+        self.Failures = 0 #number of attempts that failed
+        self.Backlog = 0 #number of bytes waiting to be copied after the last attempt
+        self.marked = False #external_marker has been written (or found) this run
+        self.event = threading.Event()
+        self.stopping = False
+        self.thread = threading.Thread(target=self.run, name="replicator", daemon=True)
+        self.thread.start()
+
+    def poke(self): #copy now instead of waiting for replicate_seconds
+        self.event.set()
+
+    def run(self):
+        while not self.stopping:
+            self.replicate()
+            self.event.wait(replicate_seconds)
+            self.event.clear()
+        self.replicate()
+
+    def replicate(self): #one catch-up pass, never raises
+        try:
+            if not external_ready(self.external_path, self.marked): #drive unplugged, don't write onto the empty mount point
+                raise FileNotFoundError(f"{self.external_path} is missing, or its {external_marker} is gone")
+            backlog = 0
+            for entry in load_index(self.local_path)["files"]:
+                backlog += self.copy(entry["file"])
+            save_index(self.external_path, load_index(self.local_path))
+            if not self.marked: #from now on the marker has to be there, so a drive pulled mid-run is noticed
+                open(os.path.join(self.external_path, external_marker), 'a').close()
+                self.marked = True
+            if not self.Available:
+                print(f"External storage available, {backlog} bytes copied")
+            self.Available = True
+            self.Backlog = 0
+        except OSError as error:
+            if self.Available is not False:
+                print(f"External storage unavailable, keeping a backlog: {error}")
+            tm.send_alert() #rate limited, the SD card is the only copy until the drive is back
+            self.Available = False
+            self.Failures += 1
+            self.Backlog = sum(max(0, os.path.getsize(self.local_path + entry["file"]) - self.copied.get(entry["file"], 0)) for entry in load_index(self.local_path)["files"] if os.path.exists(self.local_path + entry["file"]))
+
+    def copy(self, file_name): #append the bytes of file_name not yet on the external path, returns how many
+        source = self.local_path + file_name
+        target = self.external_path + file_name
+        if not os.path.exists(source):
+            return 0
+        if file_name not in self.copied: #first time this run, carry on from whatever an earlier run copied
+            self.copied[file_name] = os.path.getsize(target) if os.path.exists(target) else 0
+        size = os.path.getsize(source)
+        if size <= self.copied[file_name]:
+            return 0
+        try:
+            with open(source, 'rb') as src, open(target, 'ab') as dst:
+                src.seek(self.copied[file_name])
+                data = src.read(size - self.copied[file_name])
+                dst.write(data)
+                dst.flush()
+                os.fsync(dst.fileno())
+        except OSError: #part of the range may have reached the target, carry on from its real size so nothing is copied twice
+            try:
+                self.copied[file_name] = os.path.getsize(target)
+            except OSError:
+                self.copied.pop(file_name, None) #worked out again on the next pass
+            raise
+        self.copied[file_name] += len(data)
+        return len(data)
+
+    def stop(self, timeout=None):
+        self.stopping = True
+        self.event.set()
+        self.thread.join(timeout)
+
+def external_ready(path, marked=False): #path is a mounted drive, holds external_marker, or (until the marker has been written) is a writable folder
+    if os.path.ismount(os.path.abspath(path)) or os.path.exists(os.path.join(path, external_marker)):
+        return True
+    return not marked and os.path.isdir(path) and os.access(path, os.W_OK)
+
+def iter_frames(file_name): #decompressed frames of a compressed log, one at a time, read buffer_size bytes at a time, stops at a frame cut short by a crash
+    zstd_file = file_name.endswith(".zst")
+    errors = (zlib.error, get_zstd().ZstdError) if zstd_file else zlib.error
+    def new_decompressor():
+        return get_zstd().ZstdDecompressor().decompressobj() if zstd_file else zlib.decompressobj(31) #31 = gzip header
+    with open(file_name, 'rb') as f:
+        decompressor = new_decompressor()
+        parts = [] #output of the frame being decompressed
+        data = f.read(buffer_size)
+        while data:
+            try:
+                parts.append(decompressor.decompress(data))
+            except errors:
+                return
+            if decompressor.eof: #end of this frame, whatever was read past it starts the next one
+                yield b"".join(parts)
+                parts = []
+                data = decompressor.unused_data
+                decompressor = new_decompressor()
+            else:
+                data = b""
+            if not data:
+                data = f.read(buffer_size)
+
+def read_file(file_name): #whole contents of a log file as bytes, compressed or not
+    if file_name.endswith((".gz", ".zst")):
+        return b"".join(iter_frames(file_name))
+    with open(file_name, 'rb') as f:
+        return f.read()
+
+class SQLMEM(object): #rows in an SQLite database (WAL mode), one ticks row and one narrow readings row per probe, written in one transaction per flush
+    def __init__(self, file_name):
+        self.file_name = file_name
+        os.makedirs(os.path.dirname(file_name) or ".", exist_ok=True) #./local/ doesn't exist on a fresh card
+        self.db = sqlite3.connect(file_name, check_same_thread=False) #created here, written by the LOGGER thread
+        self.db.execute("PRAGMA journal_mode=WAL") #dashboards read while rows are written
+        self.db.execute(f"PRAGMA synchronous={'FULL' if sync_on_flush else 'NORMAL'}")
+        with self.db:
+            self.db.executescript("""
+                CREATE TABLE IF NOT EXISTS devices (id INTEGER PRIMARY KEY, name TEXT UNIQUE NOT NULL, treatment TEXT NOT NULL);
+                CREATE TABLE IF NOT EXISTS ticks (timestamp REAL PRIMARY KEY, chill_set REAL, severe_set REAL, extreme_set REAL, chill_heater INTEGER, severe_heater INTEGER, extreme_heater INTEGER);
+                CREATE TABLE IF NOT EXISTS readings (timestamp REAL NOT NULL, device INTEGER NOT NULL REFERENCES devices(id), temp REAL, PRIMARY KEY (timestamp, device)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS readings_device ON readings (device, timestamp);
+            """)
+            for treatment, devices in sqlite_treatments.items():
+                self.db.executemany("INSERT OR IGNORE INTO devices (name, treatment) VALUES (?, ?)", [(device, treatment) for device in devices])
+        ids = dict(self.db.execute("SELECT name, id FROM devices"))
+        self.device_ids = [ids[device] for devices in sqlite_treatments.values() for device in devices] #id of each temperature column
+        self.ticks = [] #rows waiting for the next transaction
+        self.readings = []
+        self.last_flush = time.monotonic()
+        atexit.register(self.close)
+
+    def save(self, data_list, timestamp=None): #buffer one row, timestamp defaults to now
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+        t = prof.to_seconds(timestamp) #naive seconds like the profile times
+        sets = [None if value != value else value for value in data_list[:3]] #NaN is stored as NULL
+        heaters = [1 if state == "on" or state == 1 else 0 for state in data_list[3:6]] #"on"/"off" as 1/0, like Telemetry's heater bits
+        self.ticks.append([t] + sets + heaters)
+        self.readings.extend((t, device, None if temp != temp else temp) for device, temp in zip(self.device_ids, data_list[6:]))
+        if len(self.ticks) >= flush_rows or time.monotonic() - self.last_flush >= flush_seconds:
+            self.flush()
+
+    def flush(self): #write the buffered rows in one transaction
+        if self.ticks and self.db is not None:
+            with self.db:
+                self.db.executemany("INSERT OR REPLACE INTO ticks VALUES (?, ?, ?, ?, ?, ?, ?)", self.ticks)
+                self.db.executemany("INSERT OR REPLACE INTO readings VALUES (?, ?, ?)", self.readings)
+            self.ticks, self.readings = [], []
+        self.last_flush = time.monotonic()
+
+    def close(self): #flush and close, safe to call more than once
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+        atexit.unregister(self.close)
+
+def open_sinks(local_path, external_path): #MEM, plus SQLMEM if sqlite_name is set, for LOGGER
+    sinks = [MEM(local_path, external_path)]
+    if sqlite_name is not None:
+        sinks.append(SQLMEM(local_path + sqlite_name)) #kept local, a live WAL database can't be copied by appending bytes
+    return sinks
+
+def connect(file_name): #read-only connection to an SQLMEM database, safe while the experiment is writing it
+    return sqlite3.connect(f"file:{file_name}?mode=ro", uri=True)
+
+def to_datetime(t):
+    return prof.epoch + datetime.timedelta(seconds=t)
+
+def query_readings(file_name, start, end, devices=None, treatment=None): #[(datetime, device, temp)] between start and end (datetimes), optionally only some devices or one treatment
+    sql = "SELECT r.timestamp, d.name, r.temp FROM readings r JOIN devices d ON d.id = r.device WHERE r.timestamp BETWEEN ? AND ?"
+    args = [prof.to_seconds(start), prof.to_seconds(end)]
+    if devices is not None:
+        sql += f" AND d.name IN ({','.join('?' * len(devices))})"
+        args += list(devices)
+    if treatment is not None:
+        sql += " AND d.treatment = ?"
+        args.append(treatment)
+    with contextlib.closing(connect(file_name)) as db:
+        return [(to_datetime(t), device, temp) for t, device, temp in db.execute(sql + " ORDER BY r.timestamp, d.id", args)]
+
+def query_device(file_name, device, start, end): #[(datetime, temp)] of one probe between start and end
+    return [(when, temp) for when, _, temp in query_readings(file_name, start, end, devices=[device])]
+
+def query_treatment(file_name, treatment, start, end): #[(datetime, device, temp)] of every probe in one treatment ("chill", "severe", "extreme" or "sump")
+    return query_readings(file_name, start, end, treatment=treatment)
+
+def query_ticks(file_name, start, end): #[(datetime, chill set, severe set, extreme set, chill heater, severe heater, extreme heater)] between start and end
+    with contextlib.closing(connect(file_name)) as db:
+        return [(to_datetime(row[0]),) + row[1:] for row in db.execute("SELECT * FROM ticks WHERE timestamp BETWEEN ? AND ? ORDER BY timestamp", (prof.to_seconds(start), prof.to_seconds(end)))]
+
+class LOGGER(object): #MEM behind a bounded queue, a writer thread does the file I/O so storage stalls never hold up the control tick
+    def __init__(self, m, size=None):
+        self.sinks = m if isinstance(m, list) else [m] #MEM, SQLMEM, or a list of them from open_sinks
+        self.m = self.sinks[0]
+        self.rows = queue.Queue(size if size is not None else queue_size)
+        self.Dropped = 0 #number of rows dropped because the queue was full
+        self.Written = 0 #number of rows every sink saved
+        self.Errors = 0 #number of sink calls that raised
+        self.failing = [] #sinks whose last call raised
+        self.thread = threading.Thread(target=self.run, name="csv writer", daemon=True)
+        self.thread.start()
+        atexit.register(self.close)
+
+    def run(self):
+        while True:
+            item = self.rows.get()
+            if item is None: #close() was called
+                break
+            if item is flush_marker:
+                for sink in self.sinks:
+                    self.call(sink, sink.flush)
+                continue
+            written = [self.call(sink, sink.save, *item) for sink in self.sinks]
+            self.Written += all(written)
+        for sink in self.sinks:
+            self.call(sink, sink.close)
+
+    def call(self, sink, method, *args): #run one sink method, errors are counted and the thread carries on so the next row tries again (MEM reopens its file)
+        try:
+            method(*args)
+        except Exception as error:
+            self.Errors += 1
+            if sink not in self.failing:
+                print(f"Log write to {type(sink).__name__} failed, retrying with the next row: {error}")
+                self.failing.append(sink)
+            return False
+        if sink in self.failing:
+            print(f"Log write to {type(sink).__name__} working again after {self.Errors} error(s)")
+            self.failing.remove(sink)
+        return True
+
+    def save(self, data_list, timestamp=None, timeout=None): #queue one row, waits up to timeout (put_timeout) seconds for space, then drops it
+        if timestamp is None:
+            timestamp = datetime.datetime.now()
+        try:
+            self.rows.put((data_list, timestamp), timeout=put_timeout if timeout is None else timeout)
+        except queue.Full:
+            self.Dropped += 1
+            print(f"Log queue full, row dropped ({self.Dropped} dropped so far)")
+
+    def flush(self): #ask the writer to flush once the rows queued so far are written
+        try:
+            self.rows.put_nowait(flush_marker)
+        except queue.Full: #the writer is behind anyway, its next flush will cover these rows
+            pass
+
+    def close(self): #write every queued row, flush and close the file, safe to call more than once
+        if self.thread.is_alive():
+            self.rows.put(None)
+            self.thread.join()
+        atexit.unregister(self.close)
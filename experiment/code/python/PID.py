@@ -1,19 +1,51 @@
-import time
+import numpy as np
 
-pid_error, pid_output = ([0,0,0] for i in range(2)) #initialize blank lists
+#Initialize PID limits
+output_limit = None #largest output magnitude, the integral stops growing while an output is pinned at it (None = no limit)
+integral_limit = None #largest error integral magnitude (None = no limit)
 
-sleep_process = 0.1 #number of seconds to sleep between readings (to allow processor to catch up)
+class PID(object): #any number of PID loops updated together in one vectorized step
+    def __init__(self, Kp, Ki, Kd, output_limit=output_limit, integral_limit=integral_limit):
+        self.set_gains(Kp, Ki, Kd)
+        loops = len(self.Kp)
+        self.output_limit = output_limit
+        self.integral_limit = integral_limit
+        self.Integral = np.zeros(loops) #sum of the errors so far
+        self.Previous = np.full(loops, np.nan) #last measured value of each loop, NaN until the first update
+        self.Derivative = np.zeros(loops) #change in the measured value over the last update, negated
+        self.Output = np.zeros(loops)
 
-def control_temps(temp_sets, measured_temps, previous_temp, error_integral, error_derivative, Kp, Ki, Kd):
-    for index_num in range(len(temp_sets)):
-        pid_error[index_num] = (temp_sets[index_num] - measured_temps[index_num]) # Calculate the error
-        pid_output[index_num] = Kp[index_num] * pid_error[index_num] + Ki[index_num] * error_integral[index_num] + Kd[index_num] * error_derivative[index_num] # Calculate the PID output
-        error_integral[index_num] += pid_error[index_num] # Update the error integral
-        error_derivative[index_num] = pid_error[index_num] - previous_temp[index_num] # Update the error derivative
-        previous_temp[index_num] = measured_temps[index_num] #previous temp is now the most recent temp (for next time)
+    def set_gains(self, Kp, Ki, Kd): #gains change with the MHW phase, the loop state carries over
+        self.Kp, self.Ki, self.Kd = np.broadcast_arrays(np.atleast_1d(np.asarray(Kp, dtype=float)), np.asarray(Ki, dtype=float), np.asarray(Kd, dtype=float))
+
+    def update(self, set_points, measured, dt=1): #one step of every loop, returns the outputs (NaN for loops with no measurement)
+        measured = np.asarray(measured, dtype=float)
+        error = np.asarray(set_points, dtype=float) - measured
+        valid = ~np.isnan(error)
+        self.Derivative = np.where(np.isnan(self.Previous) | ~valid, 0, -(measured - self.Previous) / dt) #derivative on measurement, so set point steps do not kick the output
+        unclamped = self.Kp * error + self.Ki * self.Integral + self.Kd * self.Derivative
+        self.Output = unclamped if self.output_limit is None else np.clip(unclamped, -self.output_limit, self.output_limit)
+        winding = (self.Output != unclamped) & (np.sign(error) == np.sign(unclamped)) #anti-windup: don't integrate further into a pinned output
+        self.Integral += np.where(valid & ~winding, error * dt, 0)
+        if self.integral_limit is not None:
+            np.clip(self.Integral, -self.integral_limit, self.integral_limit, out=self.Integral)
+        self.Previous = np.where(valid, measured, self.Previous) #a missed reading keeps the last good one
+        return self.Output
 
-        time.sleep(sleep_process)
-        
-    return pid_output, previous_temp, error_integral, error_derivative
+    def state(self): #loop state as lists, for Checkpoint
+        return {"integral": self.Integral.tolist(), "previous": self.Previous.tolist(), "derivative": self.Derivative.tolist(), "output": self.Output.tolist()}
 
-        
\ No newline at end of file
+    def restore(self, state): #loop state saved by state(), ignored if the number of loops changed
+        if len(state["integral"]) == len(self.Integral):
+            self.Integral, self.Previous, self.Derivative, self.Output = [np.array(state[key], dtype=float) for key in ("integral", "previous", "derivative", "output")]
+
+def control_temps(temp_sets, measured_temps, previous_temp, error_integral, error_derivative, Kp, Ki, Kd):
+    #one update of lists of loops (or a single loop as in methodsPub), the derivative is now taken on the measured temperatures
+    scalar = np.ndim(temp_sets) == 0
+    loops = PID(Kp, Ki, Kd)
+    loops.Integral = np.array(error_integral, dtype=float, ndmin=1)
+    loops.Previous = np.array(previous_temp, dtype=float, ndmin=1)
+    pid_output = loops.update(temp_sets, measured_temps)
+    if scalar:
+        return float(pid_output[0]), float(loops.Previous[0]), float(loops.Integral[0]), float(loops.Derivative[0])
+    return pid_output.tolist(), loops.Previous.tolist(), loops.Integral.tolist(), loops.Derivative.tolist()
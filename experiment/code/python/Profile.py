@@ -0,0 +1,133 @@
+import csv
+import datetime
+import os
+import struct
+import zlib
+import numpy as np
+
+epoch = datetime.datetime(1970, 1, 1) #profile times are naive seconds since this date, like the naive datetimes in mhw_sim
+
+#Initialize profile cache parameters
+cache_suffix = ".prof" #compiled profile is written next to its CSV with this suffix
+cache_magic = b"MHWPROF1"
+cache_header = struct.Struct("<8sqqIII4x") #magic, CSV mtime_ns, CSV size, hash of the compile options, rows, set point columns, padded so the arrays are 8-byte aligned
+
+def to_seconds(when): #naive datetime to profile time
+    return (when - epoch).total_seconds()
+
+class PROFILE(object): #temperature profile as sorted time and set point arrays
+    def __init__(self, times, set_points):
+        self.Times = np.asarray(times, dtype=float) #seconds since epoch of each row
+        self.SetPoints = np.asarray(set_points, dtype=float) #one row of [chill, severe, extreme] set points per time
+        if np.any(np.diff(self.Times) < 0): #compiled profiles are already sorted and stay memory-mapped
+            order = np.argsort(self.Times, kind="stable")
+            self.Times, self.SetPoints = self.Times[order], self.SetPoints[order]
+        self.Cursor = 0 #row at or before the last time looked up, ticks move forward so the next lookup is usually here
+
+    def __len__(self):
+        return len(self.Times)
+
+    def seek(self, when): #index of the last row at or before when (0 before the first row), checks the cursor before searching
+        t = to_seconds(when)
+        cursor = self.Cursor
+        last = len(self.Times) - 1
+        for index in (cursor, cursor + 1):
+            if index <= last and self.Times[index] <= t and (index == last or t < self.Times[index + 1]):
+                self.Cursor = index
+                return index
+        self.Cursor = max(0, int(np.searchsorted(self.Times, t, side="right")) - 1)
+        return self.Cursor
+
+    def nearest(self, when): #set points of the row closest to when
+        index = self.seek(when)
+        t = to_seconds(when)
+        if index + 1 < len(self.Times) and self.Times[index + 1] - t < abs(t - self.Times[index]):
+            index += 1
+        return self.SetPoints[index].tolist()
+
+    def interpolate(self, when): #set points linearly interpolated between the rows around when, held at the first/last row outside the profile
+        index = self.seek(when)
+        t = to_seconds(when)
+        if t <= self.Times[index] or index + 1 == len(self.Times):
+            return self.SetPoints[index].tolist()
+        fraction = (t - self.Times[index]) / (self.Times[index + 1] - self.Times[index])
+        return (self.SetPoints[index] + fraction * (self.SetPoints[index + 1] - self.SetPoints[index])).tolist()
+
+    def lookup(self, when, interpolate=False):
+        return self.interpolate(when) if interpolate else self.nearest(when)
+
+    def sample(self, times, interpolate=False): #nearest or interpolated set points for an array of profile times, one row per time
+        times = np.asarray(times, dtype=float)
+        if interpolate:
+            return np.column_stack([np.interp(times, self.Times, self.SetPoints[:, col]) for col in range(self.SetPoints.shape[1])])
+        after = np.clip(np.searchsorted(self.Times, times, side="right"), 1, len(self.Times) - 1) #first row after each time
+        before = after - 1
+        closer = np.where(self.Times[after] - times < np.abs(times - self.Times[before]), after, before)
+        if len(self.Times) == 1:
+            closer = np.zeros(len(times), dtype=int)
+        return self.SetPoints[closer]
+
+def parse_time(text, convert_utc=False): #ISO date or date and time from the profile CSV, as a naive datetime
+    when = datetime.datetime.fromisoformat(text.strip().replace("Z", "+00:00"))
+    if when.tzinfo is not None:
+        if convert_utc:
+            when = when.astimezone(datetime.timezone.utc)
+        when = when.replace(tzinfo=None) #otherwise keep the wall-clock time and drop the timezone, like tz_localize(None)
+    return when
+
+def read_csv(file_name, offset_days=0, columns=(3, 1, 2), convert_utc=False): #(times, set_points) from a profile CSV, columns are the chill, severe and extreme columns
+    times, set_points = [], []
+    with open(file_name, newline='') as f:
+        rows = csv.reader(f)
+        next(rows) #skip the header
+        for row in rows:
+            if not row:
+                continue
+            times.append(to_seconds(parse_time(row[0], convert_utc) + datetime.timedelta(days=offset_days)))
+            set_points.append([float(row[column]) for column in columns])
+    return np.array(times), np.array(set_points).reshape(len(times), len(columns))
+
+def options_hash(offset_days, columns, convert_utc):
+    return zlib.crc32(repr((offset_days, tuple(columns), convert_utc)).encode())
+
+def compile_profile(file_name, cache_name=None, offset_days=0, columns=(3, 1, 2), convert_utc=False): #write the CSV as a header, a block of times and a block of set points
+    cache_name = cache_name or file_name + cache_suffix
+    source = os.stat(file_name)
+    times, set_points = read_csv(file_name, offset_days, columns, convert_utc)
+    order = np.argsort(times, kind="stable")
+    temp_name = cache_name + ".tmp"
+    with open(temp_name, 'wb') as f:
+        f.write(cache_header.pack(cache_magic, source.st_mtime_ns, source.st_size, options_hash(offset_days, columns, convert_utc), len(times), len(columns)))
+        f.write(times[order].astype('<f8').tobytes())
+        f.write(np.ascontiguousarray(set_points[order], dtype='<f8').tobytes())
+    os.replace(temp_name, cache_name) #a crash mid-write never leaves a half-written cache
+    return cache_name
+
+def open_cache(cache_name, file_name=None, options=None): #PROFILE memory-mapped from a compiled profile, None if it is missing or stale
+    try:
+        with open(cache_name, 'rb') as f:
+            magic, mtime_ns, size, options_key, rows, cols = cache_header.unpack(f.read(cache_header.size))
+    except (OSError, struct.error):
+        return None
+    if magic != cache_magic:
+        return None
+    if file_name is not None:
+        source = os.stat(file_name)
+        if (mtime_ns, size) != (source.st_mtime_ns, source.st_size) or (options is not None and options_key != options_hash(*options)):
+            return None
+    if rows == 0:
+        return PROFILE(np.zeros(0), np.zeros((0, cols)))
+    data = np.memmap(cache_name, dtype='<f8', mode='r', offset=cache_header.size, shape=(rows * (1 + cols),))
+    return PROFILE(data[:rows], data[rows:].reshape(rows, cols))
+
+def load(file_name, offset_days=0, columns=(3, 1, 2), convert_utc=False): #compiled profile for a CSV, recompiled only when the CSV or the options change
+    cache_name = file_name + cache_suffix
+    options = (offset_days, columns, convert_utc)
+    profile = open_cache(cache_name, file_name, options)
+    if profile is None:
+        try:
+            compile_profile(file_name, cache_name, *options)
+        except OSError: #read-only directory, use the CSV directly this time
+            return PROFILE(*read_csv(file_name, *options))
+        profile = open_cache(cache_name)
+    return profile
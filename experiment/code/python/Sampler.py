@@ -0,0 +1,137 @@
+import threading
+import time
+import numpy as np
+import SensorAverage as savg
+import SensorInfo as sinfo
+import Temperature as tm
+
+#Initialize background sampling parameters
+sample_period = 2 #number of seconds between the start of background sweeps
+ring_depth = 15 #number of sweeps kept per probe (15 sweeps every 2 seconds = the last 30 seconds)
+max_age = 60 #number of seconds after which a sweep is too old to be used in the averages
+active = [] #samplers currently reading the bus, only one sampler (or one group of them) is allowed at a time
+bus_lock = threading.Lock() #samplers for different groups take turns on the bus
+
+class SAMPLER(object):
+    def __init__(self, temp_ctrl, period=sample_period, depth=ring_depth, window=None):
+        self.temp_ctrl = temp_ctrl
+        self.period = period
+        self.window = window if window is not None else max_age #number of seconds of sweeps used in the averages
+        self.columns = savg.probe_columns(temp_ctrl) #column of each probe in the ring
+        self.Ring = np.full((depth, len(savg.devices)), np.nan) #calibrated readings, one row per sweep
+        self.Times = np.full(depth, -np.inf) #time.perf_counter() at the start of each sweep in the ring
+        self.Count = 0 #number of sweeps written so far, the next one goes in row Count % depth
+        self.Seq = 0 #odd while a row is being written, so a snapshot can tell it raced a write
+        self.Row = np.full(len(savg.devices), np.nan) #reused for every sweep
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self, stop_others=True):
+        for sampler in list(active) if stop_others else []: #a sampler left behind by a crashed mhw_sim would double the bus traffic
+            sampler.stop()
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, name="sampler", daemon=True)
+        self.thread.start()
+        active.append(self)
+
+    def stop(self, timeout=None):
+        self.stop_event.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+        if self in active:
+            active.remove(self)
+
+    def wait_ready(self, timeout=None): #block until the first sweep is in the ring
+        end = None if timeout is None else time.perf_counter() + timeout
+        while self.Count == 0 and (end is None or time.perf_counter() < end):
+            time.sleep(0.05)
+        return self.Count > 0
+
+    def run(self):
+        next_sweep = time.perf_counter()
+        while not self.stop_event.is_set():
+            sweep_start = time.perf_counter()
+            with bus_lock:
+                self.record(savg.read_sweep(self.temp_ctrl, sweep_start + min(self.period, savg.sweep_timeout)), sweep_start)
+            next_sweep += self.period
+            if next_sweep < time.perf_counter(): #sweep ran long, start the next one now instead of catching up
+                next_sweep = time.perf_counter()
+            self.stop_event.wait(next_sweep - time.perf_counter())
+
+    def record(self, raw_temps, sweep_time): #calibrate one read_sweep result (in temp_ctrl order) into the ring
+        self.write(savg.calibrate_into(self.columns, raw_temps, self.Row), sweep_time)
+
+    def write(self, row, sweep_time): #single writer, readers never block it
+        index = self.Count % len(self.Times)
+        self.Seq += 1
+        self.Ring[index] = row
+        self.Times[index] = sweep_time
+        self.Count += 1
+        self.Seq += 1
+
+    def snapshot(self): #consistent copy of the ring and sweep times, retried if a write raced the copy
+        while True:
+            seq = self.Seq
+            if seq % 2 == 0:
+                readings = self.Ring.copy()
+                times = self.Times.copy()
+                if self.Seq == seq:
+                    return readings, times
+            time.sleep(0)
+
+    def fresh(self): #sweeps in the ring from the last window seconds
+        readings, times = self.snapshot()
+        return readings[times >= time.perf_counter() - self.window]
+
+    def checked(self): #fresh sweeps, raises if the sampler thread died and alerts if it has stalled
+        readings = self.fresh()
+        if len(readings) == 0:
+            if self.thread is not None and not self.thread.is_alive() and not self.stop_event.is_set():
+                raise RuntimeError("sampler thread died") #main restarts mhw_sim
+            print(f"No sweeps in the last {self.window} seconds, every probe in the group counts as missing")
+            tm.send_alert()
+        return readings
+
+    def get_avg_temp(self): #same (all_temps, avg_temps, sump_temps) as SensorAverage.get_avg_temp, over the fresh sweeps in the ring
+        readings = self.checked()
+        savg.report_missed(self.temp_ctrl, readings)
+        return savg.summarize_samples(readings)
+
+class MULTISAMPLER(object): #one SAMPLER per SensorInfo sample group, each sweeping its own probes at its own rate
+    def __init__(self, temp_ctrl, groups=None, periods=None, windows=None):
+        groups = groups or sinfo.sample_groups
+        periods = periods or sinfo.sample_period
+        windows = windows or sinfo.sample_window
+        self.temp_ctrl = temp_ctrl
+        self.Samplers = []
+        for group, devices in groups.items():
+            group_ctrl = [ctrl for ctrl in temp_ctrl if ctrl.Name in devices]
+            if group_ctrl:
+                depth = max(1, int(np.ceil(windows[group] / periods[group]))) #enough rows to hold the whole window
+                self.Samplers.append(SAMPLER(group_ctrl, periods[group], depth, windows[group]))
+
+    @property
+    def Count(self): #number of sweeps of the slowest group, 0 until every group has been read
+        return min((sampler.Count for sampler in self.Samplers), default=0)
+
+    def start(self):
+        for sampler in list(active):
+            sampler.stop()
+        for sampler in self.Samplers:
+            sampler.start(stop_others=False)
+
+    def stop(self, timeout=None):
+        for sampler in self.Samplers:
+            sampler.stop(timeout)
+
+    def wait_ready(self, timeout=None): #block until every group has a sweep in its ring
+        end = None if timeout is None else time.perf_counter() + timeout
+        while self.Count == 0 and (end is None or time.perf_counter() < end):
+            time.sleep(0.05)
+        return self.Count > 0
+
+    def get_avg_temp(self): #rows of different groups cover different columns, the NaNs of the others are skipped in the means
+        group_readings = [sampler.checked() for sampler in self.Samplers]
+        readings = np.concatenate(group_readings)
+        savg.report_missed(self.temp_ctrl, readings, [name for sampler, fresh in zip(self.Samplers, group_readings) for name in savg.find_missed(sampler.temp_ctrl, fresh)])
+        return savg.summarize_samples(readings)
@@ -0,0 +1,42 @@
+import datetime
+import numpy as np
+import MHWRamp as mhwr
+import Profile as prof
+
+#Initialize schedule parameters
+step = 30 #number of seconds between schedule rows, one row per control tick
+
+def compile_schedule(temp_profile, start, end, severe_thresh, extreme_thresh, mhw_date, post_mhw, step=step, interpolate=False):
+    #Every tick's set points from start to end as a PROFILE with columns [chill, severe, extreme] from the profile, then the [chill, severe, extreme] set points
+    times = np.arange(np.floor(prof.to_seconds(start) / step) * step, prof.to_seconds(end) + step, step)
+    temp_set = temp_profile.sample(times, interpolate)
+    chill = temp_set[:, 0]
+    pre = times < prof.to_seconds(mhw_date)
+    mhw = ~pre & (times < prof.to_seconds(post_mhw))
+    onset = times - prof.to_seconds(mhw_date) #seconds since the start of the MHW
+    decline = times - prof.to_seconds(post_mhw) #seconds since the start of the recovery period
+    delta_severe = np.where(mhw, mhwr.ramp_up_since(severe_thresh, onset), mhwr.ramp_down_since(severe_thresh, decline))
+    delta_extreme = np.where(mhw, mhwr.ramp_up_since(extreme_thresh, onset), mhwr.ramp_down_since(extreme_thresh, decline))
+    delta_severe[pre] = 0 #every treatment follows the chill profile before the MHW
+    delta_extreme[pre] = 0
+    return prof.PROFILE(times, np.column_stack([temp_set, chill, chill + delta_severe, chill + delta_extreme]))
+
+def set_points(schedule, when): #(temp_set, temp_sets) for the tick at when
+    row = schedule.nearest(when)
+    return row[:3], row[3:]
+
+def write_csv(schedule, file_name): #schedule as datetime, profile and set point columns, to check or plot before a run
+    with open(file_name, 'w') as f:
+        f.write("datetime,chill,severe,extreme,chill_set,severe_set,extreme_set\n")
+        dates = np.asarray(schedule.Times).astype(np.int64).astype('datetime64[s]').astype(str)
+        for date, row in zip(dates, schedule.SetPoints):
+            f.write(date + "," + ",".join(f"{value:.4f}" for value in row) + "\n")
+
+if __name__ == "__main__": #write the schedule for the whole profile next to it
+    import sys
+    import MHWsim as sim
+    temp_profile = sim.load_profile(*sys.argv[1:2])
+    start, end = [prof.epoch + datetime.timedelta(seconds=seconds) for seconds in (temp_profile.Times[0], temp_profile.Times[-1])]
+    schedule = sim.compile_schedule(temp_profile, start, end)
+    write_csv(schedule, "schedule.csv")
+    print(f"{len(schedule)} set points from {start} to {end} written to schedule.csv")
@@ -1,6 +1,6 @@
 import time
-import pandas as pd
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor, wait
 import Temperature as tm
 import SensorInfo as sinfo
 
@@ -12,29 +12,160 @@ sleep_process = 0.1 #number of seconds to sleep between ever sensor reading (to
 
 repeat_measurements = 3
 
+#Initialize acquisition mode
+acquisition_mode = "bulk" #"serial" reads the probes one after another, "parallel" reads every probe at the same time, "bulk" converts every probe with one bus command
+fallback_mode = "parallel" #per-probe mode used by "bulk" when no bus master supports bulk conversion
+max_workers = 18 #maximum number of probes read at the same time in parallel mode
+sweep_deadline = None #number of seconds to wait for every probe in a parallel sweep before giving up on the slow ones, None = budget it from the probe resolutions
+sweep_margin = 1.5 #multiple of the conversion time allowed per probe in the sweep budget
+read_overhead = 0.03 #number of seconds of bus traffic per probe read on top of its conversion
+sweep_timeout = 20 #number of seconds get_avg_temp may take in total, probes not read by then are reported missing
+missed_probes = [] #probes that missed at least one reading in the last get_avg_temp call
+pool = None #worker pool for parallel mode, created on the first parallel sweep and reused after that
+reading = {} #probe: its last parallel read, which may outlive a sweep that gave up on it
+bus = None #bus masters for bulk mode, found on the first bulk sweep
+column_cache = {} #probe names: their columns in the sample arrays
+
+def compile_calibration(): #gain/offset vectors and column lookups, built once so a sweep does no per-reading lookups
+    global devices, columns, gain, offset, chill_cols, severe_cols, extreme_cols, sump_cols, samples
+    devices = sinfo.chill_devices + sinfo.severe_devices + sinfo.extreme_devices + sinfo.sump_devices #column order of every sample array
+    columns = dict([(device, index) for index, device in enumerate(devices)])
+    raw_high = np.array([sinfo.device_cal[device][0] for device in devices]) #high calibration value for each sensor
+    raw_low = np.array([sinfo.device_cal[device][1] for device in devices]) #low calibration value for each sensor
+    gain = sinfo.ref_range / (raw_high - raw_low) #calibrated = raw * gain + offset
+    offset = sinfo.ref_low - raw_low * gain
+    chill_cols, severe_cols, extreme_cols = [np.array([columns[device] for device in device_list]) for device_list in [sinfo.chill_devices, sinfo.severe_devices, sinfo.extreme_devices]]
+    sump_cols = np.array([columns[device] for device in sinfo.sump_devices])[[2, 0, 1]] #reorder sump tank temperatures from chill > extreme
+    samples = np.full((repeat_measurements, len(devices)), np.nan) #reused by every get_avg_temp call
+
+def calibrate_temp(name, raw_temp): #calibrate a single reading
+    return raw_temp * gain[columns[name]] + offset[columns[name]]
+
+def calibrate_into(cols, raw_temps, row): #calibrate one sweep (raw_temps in the order of cols) into row, probes not in cols stay NaN
+    row.fill(np.nan)
+    row[cols] = raw_temps
+    row *= gain
+    row += offset
+    return row
+
+def probe_columns(temp_ctrl): #column of each probe in temp_ctrl, cached so it is only worked out once per probe list
+    key = tuple(ctrl.Name for ctrl in temp_ctrl)
+    cols = column_cache.get(key)
+    if cols is None:
+        unknown = [name for name in key if name not in columns]
+        if unknown:
+            raise KeyError(f"probes not listed in SensorInfo: {unknown}")
+        cols = np.array([columns[name] for name in key], dtype=int)
+        column_cache[key] = cols
+    return cols
+
+def sweep_budget(temp_ctrl, parallel=True): #number of seconds a sweep over temp_ctrl should take at their resolutions
+    if not temp_ctrl:
+        return 0
+    if parallel: #conversions overlap, the slowest probe sets the pace but reads still share the bus
+        return max(ctrl.ConversionTime for ctrl in temp_ctrl) * sweep_margin + len(temp_ctrl) * read_overhead
+    return sum(ctrl.ConversionTime * sweep_margin + read_overhead for ctrl in temp_ctrl)
+
+def read_probe(ctrl, deadline=None):
+    return ctrl.load_temp(deadline) #read a single probe (runs on a worker thread in parallel mode), missing stays NaN
+
+def sleep_until(seconds, sweep_end): #sleep, but never past the end of the sweep
+    time.sleep(max(0, min(seconds, sweep_end - time.perf_counter())))
+
 def get_avg_temp(temp_ctrl, sleep_repeat):
-    all_temps_df = pd.DataFrame(0, index = np.arange(3), columns = (sinfo.chill_devices + sinfo.severe_devices + sinfo.extreme_devices + sinfo.sump_devices))
+    sweep_end = time.perf_counter() + sweep_timeout
+    cols = probe_columns(temp_ctrl)
     for number_of_rows in range(repeat_measurements):
-        for index in range(len(temp_ctrl)):
-            temp_ctrl[index].load_temp() #Read temperatures on chill tank sensors
-            device_cal_val = sinfo.device_cal[temp_ctrl[index].Name] #Get calibration values for sensor
-            raw_high =  device_cal_val[0] #Read in high calibration value for sensor
-            raw_low = device_cal_val[1] #Read in low calibration value for sensor
-            raw_range = raw_high - raw_low #Calculate the calibration value range
-            calibrated_val = (((temp_ctrl[index].Temp  - raw_low) * sinfo.ref_range) / raw_range) + sinfo.ref_low #Calibrate sensor readings
-            matching_cell = all_temps_df.columns.get_loc(temp_ctrl[index].Name)
-            all_temps_df.iloc[(number_of_rows, matching_cell)] = calibrated_val
-            time.sleep(sleep_process)
-        time.sleep(sleep_repeat)
-    avg_chill = all_temps_df[all_temps_df.columns.intersection(sinfo.chill_devices)].mean().mean()
-    avg_severe = all_temps_df[all_temps_df.columns.intersection(sinfo.severe_devices)].mean().mean()
-    avg_extreme = all_temps_df[all_temps_df.columns.intersection(sinfo.extreme_devices)].mean().mean()
+        calibrate_into(cols, read_sweep(temp_ctrl, sweep_end), samples[number_of_rows]) #missed readings stay NaN so they are skipped in the averages
+        sleep_until(sleep_repeat, sweep_end)
+    report_missed(temp_ctrl, samples)
+    return summarize_samples(samples)
+
+def read_sweep(temp_ctrl, sweep_end): #one raw reading from every probe (in temp_ctrl order) using acquisition_mode
+    if acquisition_mode == "bulk":
+        return read_sweep_bulk(temp_ctrl, sweep_end)
+    if acquisition_mode == "parallel":
+        return read_sweep_parallel(temp_ctrl, sweep_end)
+    return read_sweep_serial(temp_ctrl, sweep_end)
+
+def read_sweep_serial(temp_ctrl, sweep_end):
+    raw_temps = []
+    for ctrl in temp_ctrl:
+        if time.perf_counter() + ctrl.ConversionTime > sweep_end: #no time left to read this probe
+            raw_temps.append(tm.missing)
+        else:
+            raw_temps.append(read_probe(ctrl, sweep_end))
+        sleep_until(sleep_process, sweep_end)
+    return raw_temps
+
+def read_sweep_parallel(temp_ctrl, sweep_end):
+    global pool
+    if pool is None:
+        pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="probe") #shared by every sampler group, so it is sized for all the probes rather than the first caller's
+    deadline = sweep_deadline if sweep_deadline is not None else sweep_budget(temp_ctrl)
+    repeat_end = min(time.perf_counter() + deadline, sweep_end)
+    futures = []
+    for ctrl in temp_ctrl: #start a read on every probe at once
+        previous = reading.get(ctrl)
+        if previous is not None and not previous.done(): #an earlier read that timed out is still using the probe's buffer and file, skip it this time
+            futures.append(None)
+        else:
+            futures.append(pool.submit(read_probe, ctrl, repeat_end))
+            reading[ctrl] = futures[-1]
+    done, not_done = wait([future for future in futures if future is not None], timeout=max(0, repeat_end - time.perf_counter())) #wait for the whole sweep, but no longer than the deadline
+    for future in not_done:
+        future.cancel()
+    return [future.result() if future in done else tm.missing for future in futures]
+
+def read_sweep_bulk(temp_ctrl, sweep_end):
+    global bus
+    if bus is None:
+        bus = tm.BUS()
+    if not bus.Triggers: #kernel or bus master without bulk conversion, use the per-probe path instead
+        if fallback_mode == "parallel":
+            return read_sweep_parallel(temp_ctrl, sweep_end)
+        return read_sweep_serial(temp_ctrl, sweep_end)
+    conversion_time = tm.bus_conversion_time() * sweep_margin + read_overhead #therm_bulk_read stays -1 until every probe on the bus is done, not just these
+    converted = bus.convert(min(conversion_time, max(0, sweep_end - time.perf_counter()))) #one conversion for the whole bus instead of one per probe
+    raw_temps = []
+    for ctrl in temp_ctrl:
+        if time.perf_counter() + read_overhead > sweep_end: #no time left to read this probe
+            raw_temps.append(tm.missing)
+        else:
+            raw_temps.append(ctrl.load_converted(sweep_end) if converted else ctrl.load_temp(sweep_end)) #per-probe conversion if the bulk conversion failed
+    return raw_temps
+
+def find_missed(temp_ctrl, samples): #names of the probes in temp_ctrl that missed a reading in samples, every probe if samples is empty
+    if len(samples) == 0: #no sweeps at all, e.g. a stalled sampler
+        return [ctrl.Name for ctrl in temp_ctrl]
+    missed = np.isnan(samples).any(axis=0)
+    return [temp_ctrl[index].Name for index, col in enumerate(probe_columns(temp_ctrl)) if missed[col]]
+
+def report_missed(temp_ctrl, samples, missed=None): #list the probes that missed a reading in samples (or the names in missed)
+    global missed_probes
+    missed_probes = find_missed(temp_ctrl, samples) if missed is None else missed
+    if missed_probes:
+        print(f"Probes missing readings this sweep: {missed_probes}")
+    return missed_probes
+
+def summarize_samples(samples): #(all_temps, avg_temps, sump_temps) from a (readings, devices) array of calibrated temperatures
+    valid = ~np.isnan(samples)
+    counts = valid.sum(axis=0)
+    sums = np.where(valid, samples, 0).sum(axis=0)
+    means = np.divide(sums, counts, out=np.full(len(devices), np.nan), where=counts > 0) #mean of each sensor, NaN if it never read
+    avg_chill, avg_severe, avg_extreme = [group_mean(means, cols) for cols in [chill_cols, severe_cols, extreme_cols]]
     print(f"The chill tank temp average is {avg_chill}")
     print(f"The severe tank temp average is {avg_severe}")
     print(f"The extreme tank temp average is {avg_extreme}")
     avg_temps = [avg_chill, avg_severe, avg_extreme] #create list of average temperatures for each treatment
-    all_temps = all_temps_df.mean(axis=0).apply(lambda x: round(x,3)).tolist() #create a list of the mean average temps for each sensor, rounded to 3 digits
-    sump_temps = all_temps[-3:] #extract sump tank temperatures
-    sump_temps[0], sump_temps[1] , sump_temps[2] = sump_temps[2], sump_temps[0], sump_temps[1] #reorder sump tank temperatures from chill > extreme
-            
+    all_temps = np.round(means, 3).tolist() #create a list of the mean average temps for each sensor, rounded to 3 digits
+    sump_temps = np.round(means[sump_cols], 3).tolist() #extract sump tank temperatures, ordered chill > extreme
+
     return all_temps, avg_temps, sump_temps
+
+def group_mean(means, cols): #average of the sensor means in cols, skipping sensors that never read
+    group = means[cols]
+    group = group[~np.isnan(group)]
+    return float(group.mean()) if len(group) else float('nan')
+
+compile_calibration()
@@ -4,6 +4,17 @@ severe_devices = ["28-00000eb50e10","28-00000eb501b0", "28-00000eb496d2", "28-00
 extreme_devices = ["28-00000ec23ab6","28-00000ec25534","28-00000eb4b7e0", "28-00000ec24f93", "28-00000eb4619b"]
 sump_devices = ["28-00000eb3f54e", "28-00000eb4a798", "28-00000eb3e681"]
 
+#Establish temperature sensor resolution (9-12 bit), fewer bits convert faster but read coarser
+default_resolution = 12 #DS18B20 power-on resolution
+conversion_time = {9: 0.09375, 10: 0.1875, 11: 0.375, 12: 0.75} #number of seconds one conversion takes at each resolution
+resolution_step = {9: 0.5, 10: 0.25, 11: 0.125, 12: 0.0625} #degrees C per reading step at each resolution
+device_resolution = dict([(device, 10) for device in chill_devices + severe_devices + extreme_devices] + [(device, 11) for device in sump_devices]) #replicate tanks are averaged over 5 probes, sump probes feed the PID and need a fast response
+
+#Establish sampling rate of each group of sensors, each group is swept on its own schedule by Sampler
+sample_groups = {"sump": sump_devices, "tank": chill_devices + severe_devices + extreme_devices}
+sample_period = {"sump": 5, "tank": 60} #number of seconds between sweeps, sump probes feed the PID and replicate tanks only gate the heaters
+sample_window = {"sump": 15, "tank": 120} #number of seconds of sweeps averaged for each group
+
 #Establish temperature sensor calibration parameters
 ref_high = 49 #Oakley lab water bath temperature
 ref_low = 0 #ice bath temperature
@@ -0,0 +1,192 @@
+import errno
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import Alert
+import Devices as dev
+import SensorInfo as sinfo
+import Temperature as tm
+
+#Initialize simulator parameters
+ambient_temp = 15 #raw temperature every simulated probe starts at
+noise = 0.05 #standard deviation of the simulated reading noise, degrees C
+read_time = 0.015 #number of seconds one probe holds the bus to send its scratchpad
+alerts = 0 #number of alerts the simulator swallowed instead of emailing
+send_email = Alert.send_email #the real one, put back by use_hardware
+heating_rate = 2/3600 #degrees C per second a tank warms while its heater is on
+cooling_rate = 1/3600 #degrees C per second a tank cools back toward ambient_temp while its heater is off
+
+def w1_slave_text(millidegrees, crc_pass): #same layout as the kernel's w1_slave file
+    scratchpad = "72 01 4b 46 7f ff 0e 10 57"
+    return f"{scratchpad} : crc=57 {'YES' if crc_pass else 'NO'}\n{scratchpad} t={millidegrees}\n"
+
+class SIMW1(dev.W1): #fake /sys/bus/w1/devices tree with conversion latency and fault injection
+    def __init__(self, devices=None, conversion_latency=None, crc_failure_rate=0, dead_probes=(), bulk=True, temperature_attr=True, gpio=None, heater_devices=None, seed=None):
+        dev.W1.__init__(self, tempfile.mkdtemp(prefix="w1_") + '/')
+        self.devices = devices if devices is not None else sinfo.chill_devices + sinfo.severe_devices + sinfo.extreme_devices + sinfo.sump_devices
+        self.conversion_latency = conversion_latency #fixed number of seconds per conversion, None = from each probe's resolution
+        self.crc_failure_rate = crc_failure_rate #fraction of reads that fail their CRC check
+        self.dead_probes = set(dead_probes) #probes whose reads fail like a probe that dropped off the bus
+        self.gpio = gpio #heaters on these pins warm the probes in heater_devices
+        self.heater_devices = heater_devices or {} #heater pin: list of probes in the tanks it heats
+        self.random = random.Random(seed)
+        self.temps = dict([(device, ambient_temp) for device in self.devices]) #true (raw) temperature at each probe
+        self.resolution = dict([(device, sinfo.default_resolution) for device in self.devices])
+        self.bus_lock = threading.Lock() #conversions overlap, but only one probe talks on the bus at a time
+        self.converted = set() #probes holding the result of a bulk conversion
+        self.bulk_done = 0 #time.perf_counter() when the last bulk conversion finishes
+        self.last_step = time.perf_counter()
+        self.reads = 0 #number of conversions read, for load tests
+        self.crc_failures = 0 #number of reads that failed their CRC check
+        for device in self.devices:
+            os.makedirs(self.base_dir + device)
+            dev.W1.write(self, self.base_dir + device + '/w1_slave', w1_slave_text(ambient_temp * 1000, True))
+            dev.W1.write(self, self.base_dir + device + '/resolution', str(sinfo.default_resolution) + '\n')
+            if temperature_attr:
+                dev.W1.write(self, self.base_dir + device + '/temperature', str(ambient_temp * 1000) + '\n')
+        if bulk:
+            os.makedirs(self.base_dir + 'w1_bus_master1')
+            dev.W1.write(self, self.base_dir + 'w1_bus_master1/therm_bulk_read', '0\n')
+
+    def conversion_time(self, device):
+        if self.conversion_latency is not None:
+            return self.conversion_latency
+        return sinfo.conversion_time[self.resolution[device]]
+
+    def step(self): #warm the tanks whose heater is on, cool the rest toward ambient
+        now = time.perf_counter()
+        seconds = now - self.last_step
+        self.last_step = now
+        if self.gpio is None:
+            return
+        for pin, devices in self.heater_devices.items():
+            for device in devices:
+                if self.gpio.input(pin):
+                    self.temps[device] += heating_rate * seconds
+                else:
+                    self.temps[device] -= min(cooling_rate * seconds, max(0, self.temps[device] - ambient_temp))
+
+    def sample(self, device): #millidegrees the probe reports, with noise and quantized to its resolution
+        step = sinfo.resolution_step[self.resolution[device]]
+        return int(round(round((self.temps[device] + self.random.gauss(0, noise)) / step) * step * 1000))
+
+    def read_into(self, fd, views, path):
+        device, attr = path.split('/')[-2:]
+        if device in self.dead_probes:
+            raise OSError(errno.ENODEV, "simulated dead probe", path)
+        if attr in ('w1_slave', 'temperature'):
+            self.step()
+            if attr == 'temperature' and device in self.converted: #bulk result, empty until the conversion is done
+                if time.perf_counter() < self.bulk_done:
+                    dev.W1.write(self, path, '')
+                    return dev.W1.read_into(self, fd, views, path)
+                self.converted.discard(device)
+            else:
+                time.sleep(self.conversion_time(device))
+            with self.bus_lock:
+                time.sleep(read_time)
+            self.reads += 1
+            crc_pass = self.random.random() >= self.crc_failure_rate
+            if not crc_pass:
+                self.crc_failures += 1
+            if attr == 'temperature':
+                if not crc_pass: #the kernel checks the CRC itself for this attribute
+                    raise OSError(errno.EIO, "simulated CRC failure", path)
+                dev.W1.write(self, path, str(self.sample(device)) + '\n')
+            else:
+                dev.W1.write(self, path, w1_slave_text(self.sample(device), crc_pass))
+        return dev.W1.read_into(self, fd, views, path)
+
+    def read(self, path):
+        if path.endswith('/therm_bulk_read'): #-1 = conversion in progress, 1 = results waiting to be read, 0 = nothing pending
+            if time.perf_counter() < self.bulk_done:
+                return '-1\n'
+            return '1\n' if self.converted else '0\n'
+        return dev.W1.read(self, path)
+
+    def write(self, path, text):
+        if path.endswith('/therm_bulk_read') and text.strip() == 'trigger':
+            live_devices = [device for device in self.devices if device not in self.dead_probes]
+            self.converted = set(live_devices)
+            self.bulk_done = time.perf_counter() + max((self.conversion_time(device) for device in live_devices), default=0)
+            return
+        dev.W1.write(self, path, text)
+        if path.endswith('/resolution'):
+            self.resolution[path.split('/')[-2]] = int(text.strip())
+
+    def cleanup(self): #remove the fake tree
+        shutil.rmtree(self.base_dir, ignore_errors=True)
+
+class SIMGPIO(object): #in-memory stand-in for RPi.GPIO
+    HIGH = 1
+    LOW = 0
+    BCM = 11
+    BOARD = 10
+    OUT = 0
+    IN = 1
+
+    def __init__(self, latency=0):
+        self.latency = latency #number of seconds each output call takes
+        self.states = {} #pin: current level
+        self.outputs = 0 #number of output calls, for load tests
+        self.mode = None
+
+    def setwarnings(self, flag):
+        pass
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setup(self, pins, direction, initial=0):
+        for pin in (pins if isinstance(pins, (list, tuple)) else [pins]):
+            self.states[pin] = initial
+
+    def output(self, pins, values): #one pin and value, or lists of them like RPi.GPIO
+        if self.latency:
+            time.sleep(self.latency)
+        self.outputs += 1
+        pins = pins if isinstance(pins, (list, tuple)) else [pins]
+        values = values if isinstance(values, (list, tuple)) else [values] * len(pins)
+        for pin, value in zip(pins, values):
+            self.states[pin] = int(bool(value))
+
+    def input(self, pin):
+        return self.states.get(pin, 0)
+
+    def cleanup(self):
+        self.states = {}
+
+def default_heater_devices(heater_pins): #chill, severe and extreme heaters warm their replicate tanks and sump (sump order as in SensorAverage)
+    return {heater_pins[0]: sinfo.chill_devices + [sinfo.sump_devices[2]],
+            heater_pins[1]: sinfo.severe_devices + [sinfo.sump_devices[0]],
+            heater_pins[2]: sinfo.extreme_devices + [sinfo.sump_devices[1]]}
+
+def count_alert(): #stands in for emailing while simulating, so fault injection never pages anyone
+    global alerts
+    alerts += 1
+    print(f"Simulated alert ({alerts} so far)")
+
+def use_simulator(heater_pins=None, gpio_latency=0, **options): #point Devices at a new simulated bus and GPIO, returns (w1, gpio)
+    gpio = SIMGPIO(gpio_latency)
+    if heater_pins is not None and 'heater_devices' not in options:
+        options['heater_devices'] = default_heater_devices(heater_pins)
+    w1 = SIMW1(gpio=gpio, **options)
+    dev.w1 = w1
+    dev.GPIO = gpio
+    tm.alert_hook = count_alert
+    Alert.send_email = count_alert #main.py and MHWasync's alert loop email directly
+    return w1, gpio
+
+def use_hardware(): #point Devices back at the real sysfs and RPi.GPIO
+    dev.w1 = dev.W1()
+    dev.GPIO = None
+    tm.alert_hook = None
+    Alert.send_email = send_email
+
+if __name__ == "__main__": #run the whole simulator on a plain Linux box
+    import MHWsim as sim
+    use_simulator(heater_pins=sim.heater_pins)
+    sim.mhw_sim()
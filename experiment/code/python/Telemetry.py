@@ -0,0 +1,77 @@
+import os
+import struct
+import numpy as np
+import SensorInfo as sinfo
+
+#Initialize telemetry format parameters
+magic = b"MHWTLM1\n"
+schema_version = 1
+missing = -2**31 #stored for a NaN (missed) temperature
+header_fields = struct.Struct("<HHHHI") #schema version, set points, heaters, devices, header size in bytes (records start there)
+set_names = ["Chill set", "Severe set", "Extreme set"]
+heater_names = ["Chill heater", "Severe heater", "Extreme heater"]
+
+def schema_devices(): #device order of every record, same as the CSV columns
+    return sinfo.chill_devices + sinfo.severe_devices + sinfo.extreme_devices + sinfo.sump_devices
+
+def record_dtype(num_sets, num_heaters, num_devices): #timestamp in seconds, set points and temperatures in millidegrees, heater states as bits
+    return np.dtype([("timestamp", "<f8"), ("set", "<i4", (num_sets,)), ("heaters", "<u2"), ("temps", "<i4", (num_devices,))])
+
+def header(devices=None, num_sets=len(set_names), num_heaters=len(heater_names)): #magic, sizes and the device order, padded to 8 bytes
+    devices = devices or schema_devices()
+    names = "\n".join(devices).encode("ascii")
+    size = len(magic) + header_fields.size + len(names)
+    size += -size % 8
+    return (magic + header_fields.pack(schema_version, num_sets, num_heaters, len(devices), size) + names).ljust(size, b"\0")
+
+class ENCODER(object): #packs one MEM row into a fixed-size record with a precompiled struct
+    def __init__(self, devices=None, num_sets=len(set_names), num_heaters=len(heater_names)):
+        self.devices = devices or schema_devices()
+        self.num_sets = num_sets
+        self.num_heaters = num_heaters
+        self.record = struct.Struct("<d%diH%di" % (num_sets, len(self.devices))) #same layout as record_dtype
+        self.header = header(self.devices, num_sets, num_heaters)
+
+    def encode(self, data_list, timestamp): #data_list is set points, then "on"/"off" heater states, then temperatures, like a CSV row
+        sets = data_list[:self.num_sets]
+        heaters = data_list[self.num_sets:self.num_sets + self.num_heaters]
+        temps = data_list[self.num_sets + self.num_heaters:]
+        bits = sum(1 << index for index, state in enumerate(heaters) if state == "on" or state == 1)
+        return self.record.pack(timestamp.timestamp(), *[millidegrees(value) for value in sets], bits, *[millidegrees(value) for value in temps])
+
+def millidegrees(value):
+    return missing if value != value else int(round(value * 1000)) #value != value only for NaN
+
+def read_header(buf): #(devices, num_sets, num_heaters, header size) from the start of a telemetry file
+    if bytes(buf[:len(magic)]) != magic:
+        raise ValueError("not a telemetry file")
+    version, num_sets, num_heaters, num_devices, size = header_fields.unpack_from(buf, len(magic))
+    if version != schema_version:
+        raise ValueError(f"telemetry schema version {version}, expected {schema_version}")
+    devices = bytes(buf[len(magic) + header_fields.size:size]).rstrip(b"\0").decode("ascii").split("\n")[:num_devices]
+    return devices, num_sets, num_heaters, size
+
+def read(file_name): #(devices, records) with records memory-mapped from the file, a partly written last record is left out
+    with open(file_name, 'rb') as f:
+        start = f.read(len(magic) + header_fields.size)
+        f.seek(0)
+        devices, num_sets, num_heaters, size = read_header(f.read(header_fields.unpack_from(start, len(magic))[-1] if len(start) == len(magic) + header_fields.size else len(start)))
+        length = os.fstat(f.fileno()).st_size
+    dtype = record_dtype(num_sets, num_heaters, len(devices))
+    count = (length - size) // dtype.itemsize
+    if count == 0:
+        return devices, np.zeros(0, dtype)
+    return devices, np.memmap(file_name, dtype=dtype, mode='r', offset=size, shape=(count,))
+
+def from_bytes(buf): #(devices, records) from a telemetry file already in memory, e.g. after decompressing it
+    devices, num_sets, num_heaters, size = read_header(buf)
+    dtype = record_dtype(num_sets, num_heaters, len(devices))
+    count = (len(buf) - size) // dtype.itemsize
+    return devices, np.frombuffer(buf, dtype=dtype, count=count, offset=size)
+
+def to_degrees(records): #(timestamps, set points, heater states, temperatures) as float arrays in degrees C, NaN where a reading was missed
+    num_heaters = len(heater_names)
+    heaters = (records["heaters"][:, None] >> np.arange(num_heaters)) & 1
+    sets = np.where(records["set"] == missing, np.nan, records["set"] / 1000)
+    temps = np.where(records["temps"] == missing, np.nan, records["temps"] / 1000)
+    return records["timestamp"], sets, heaters, temps
@@ -1,45 +1,181 @@
+import threading
 import time
 import Alert
+import Devices as dev
+import SensorInfo as sinfo
 
 wait_time = 0
 
+bulk_timeout = 1 #number of seconds to wait for a bulk conversion to finish on every bus
+bulk_poll = 0.05 #number of seconds to sleep between checks on a bulk conversion
+crc_retries = 3 #number of times to re-read a probe that has not passed its CRC check
+retry_wait = 0.2 #number of seconds to wait before re-reading a probe
+alert_hook = None #called instead of emailing from a new thread when a probe fails, e.g. to queue the alert on an event loop
+conversion_times = {} #probe name: number of seconds one conversion takes, for every TEMP created so far
+missing = float('nan') #sample returned when a probe could not be read in time, skipped by the averages
+read_size = 128 #number of bytes to read from a probe file (w1_slave is two lines of ~40 characters)
+
+def is_missing(temp_c):
+    return temp_c != temp_c #only NaN is not equal to itself
+
+def crc_ok(buf, num_bytes): #the first line of w1_slave ends in YES when the CRC check passed
+    line_end = buf.find(b'\n', 0, num_bytes)
+    return line_end >= 3 and buf.startswith(b'YES', line_end - 3, line_end)
+
+def parse_millidegrees(buf, start, end): #parse a (signed) integer straight from the buffer without making a string
+    sign = 1
+    if start < end and buf[start] == 45: #minus sign
+        sign = -1
+        start += 1
+    value = 0
+    index = start
+    while index < end and 48 <= buf[index] <= 57: #stop at the first non-digit (newline)
+        value = value * 10 + buf[index] - 48
+        index += 1
+    if index == start:
+        raise ValueError("no temperature in probe file")
+    return sign * value
+
 class TEMP(object):
-    def __init__(self, device_folder):
+    def __init__(self, device_folder, resolution=None):
         self.Probe = device_folder + '/w1_slave'
+        self.Temperature = device_folder + '/temperature' #single value attribute, holds the result of a bulk conversion
+        self.Resolution_file = device_folder + '/resolution'
         self.Name = device_folder.split('/')[-1]
         self.Temp = []
+        if resolution is None:
+            resolution = sinfo.device_resolution.get(self.Name) #resolution from SensorInfo, None leaves the probe as it is
+        self.Resolution = self.set_resolution(resolution)
+        self.ConversionTime = sinfo.conversion_time[self.Resolution] #number of seconds one conversion takes on this probe
+        conversion_times[self.Name] = self.ConversionTime
+        self.Source = self.Temperature if dev.w1.exists(self.Temperature) else self.Probe #prefer the single value attribute where the kernel has it
+        self.Buffer = bytearray(read_size) #reused for every read so reading a probe does not allocate
+        self.View = [memoryview(self.Buffer)]
+        self.Files = {} #file descriptors kept open between reads
+
+    def set_resolution(self, resolution): #apply the resolution through sysfs, returns the resolution the probe reports back
+        if resolution is not None:
+            try:
+                dev.w1.write(self.Resolution_file, str(resolution) + '\n')
+            except OSError:
+                print(f"could not set {self.Name} to {resolution} bit")
+        try:
+            resolution = int(dev.w1.read(self.Resolution_file).strip())
+        except (OSError, ValueError):
+            pass #older kernels have no resolution attribute
+        if resolution not in sinfo.conversion_time:
+            resolution = sinfo.default_resolution
+        return resolution
 
-    def load_temp(self): #unnecessary, from when there were two thermistors per tank
-        self.Temp = self.read_temp(self.Probe) #NOT NEEDED! :)
+    def load_temp(self, deadline=None): #unnecessary, from when there were two thermistors per tank
+        self.Temp = self.read_temp(self.Source, deadline) #NOT NEEDED! :)
         return self.Temp
 
+    def load_converted(self, deadline=None): #read the result of a bulk conversion without starting a new one
+        try:
+            num_bytes = self.read_bytes(self.Temperature)
+            if num_bytes: #empty while the conversion is still in progress
+                self.Temp = parse_millidegrees(self.Buffer, 0, num_bytes)/1000.0
+                return self.Temp
+        except (OSError, ValueError):
+            pass
+        return self.load_temp(deadline) #fall back to a normal per-probe conversion
+
+    def read_bytes(self, device_file): #read the whole probe file into the buffer, returns the number of bytes read
+        fd = self.Files.get(device_file)
+        if fd is None:
+            fd = dev.w1.open(device_file)
+            self.Files[device_file] = fd
+        try:
+            return dev.w1.read_into(fd, self.View, device_file)
+        except OSError:
+            self.close_file(device_file) #reopen on the next read, e.g. after the probe drops off the bus
+            raise
+
+    def close_file(self, device_file):
+        fd = self.Files.pop(device_file, None)
+        if fd is not None:
+            dev.w1.close(fd)
+
+    def close(self): #close every file descriptor held by this probe
+        for device_file in list(self.Files):
+            self.close_file(device_file)
+
     # https://www.circuitbasics.com/raspberry-pi-ds18b20-temperature-sensor-tutorial/
-    def read_temp_raw(self, device_file):
-        f = open(device_file, 'r')
-        lines = f.readlines()
-        f.close
-        return lines
+    def read_temp(self, device_file, deadline=None): #gives up after crc_retries or at deadline (time.perf_counter() seconds) and returns missing
+        reason = "thermistor CRC failure"
+        try:
+            for attempt in range(crc_retries + 1):
+                if attempt: #wait before trying again, unless the retry would run past the deadline
+                    if deadline is not None and time.perf_counter() + retry_wait + self.ConversionTime > deadline:
+                        break
+                    time.sleep(retry_wait)
+                try:
+                    num_bytes = self.read_bytes(device_file)
+                except OSError: #the temperature attribute reports a CRC failure as EIO, retried like a failed CRC line
+                    reason = "thermistor failure"
+                    continue
+                reason = "thermistor CRC failure"
+                if device_file == self.Temperature: #kernel already checked the CRC, file holds millidegrees
+                    if num_bytes:
+                        return parse_millidegrees(self.Buffer, 0, num_bytes)/1000.0
+                elif crc_ok(self.Buffer, num_bytes): #only trust the reading once the CRC line says YES
+                    equals_pos = self.Buffer.find(b't=', 0, num_bytes)
+                    if equals_pos != -1:
+                        return parse_millidegrees(self.Buffer, equals_pos+2, num_bytes)/1000.0
+        except Exception:
+            reason = "thermistor failure"
+        self.report_failure(device_file, reason)
+        return missing
+
+    def report_failure(self, device_file, reason):
+        print(device_file)
+        print(reason)
+        send_alert()
+
+def send_alert(): #email at most once every 5 minutes, without holding up the caller
+    global wait_time
+    now = time.perf_counter()
+    if now > wait_time:
+        if alert_hook is not None:
+            alert_hook()
+        else:
+            threading.Thread(target=Alert.send_email, daemon=True).start() #send the alert without holding up the sweep
+        wait_time = now+5*60
+
+def bus_conversion_time(): #number of seconds a bulk conversion takes, set by the slowest probe on the bus rather than the ones being swept
+    return max(conversion_times.values(), default=max(sinfo.conversion_time.values()))
+
+class BUS(object):
+    def __init__(self):
+        self.Triggers = dev.w1.find('w1_bus_master*/therm_bulk_read') #bus masters that can convert every probe at once
 
-    def read_temp(self, device_file):
+    def read_status(self, trigger): #-1 = conversion in progress, 1 = conversion done, 0 = no bulk conversion pending
+        return dev.w1.read(trigger).strip()
+
+    def trigger(self): #start one simultaneous conversion on every bus
+        for trigger in self.Triggers:
+            dev.w1.write(trigger, 'trigger\n')
+
+    def pending(self): #buses whose bulk conversion is still in progress
+        return [trigger for trigger in self.Triggers if self.read_status(trigger) == '-1']
+
+    def convert(self, timeout=bulk_timeout): #start one simultaneous conversion on every bus and wait for it to finish
+        if not self.Triggers:
+            return False
         try:
-            lines = self.read_temp_raw(device_file)
-            while lines[0].strip()[-3:] != 'YES':
-                time.sleep(0.2) #wait for the YES before trying again
-                lines = self.read_temp_raw(device_file)
-            equals_pos = lines[1].find('t=')
-            if equals_pos != -1:
-                temp_string = lines[1][equals_pos+2:]
-                temp_c = float(temp_string)/1000.0
-                return temp_c
-        except:
-            temp_c = float(-1)
-            print(device_file)
-            print("thermistor failure")
-            now = time.perf_counter()
-            if now > wait_time:
-                Alert.send_email()
-                wait_time = now+5*60
-            return temp_c
+            self.trigger()
+            deadline = time.perf_counter() + timeout
+            while self.pending():
+                if time.perf_counter() > deadline:
+                    print("bulk conversion timed out")
+                    return False
+                time.sleep(bulk_poll)
+            return True
+        except OSError:
+            print("bulk conversion failed")
+            return False
+
 """   
 def read_temp_raw(device_file):
     f = open(device_file, 'r')
@@ -0,0 +1,51 @@
+import datetime
+import time
+
+#Initialize tick parameters
+late_tolerance = 1 #number of seconds past its deadline a tick may still start, later than that it is counted as missed
+drift_tolerance = 0.5 #number of seconds a tick may start away from its wall-clock boundary before the deadlines are lined up again
+
+class TICKER(object): #deadlines every period seconds on the monotonic clock, lined up with wall-clock multiples of period
+    def __init__(self, period, offset=0):
+        self.period = period #number of seconds between ticks, e.g. 30 for the :00 and :30 marks or 15 as in MHWpublication
+        self.offset = offset #number of seconds after each wall-clock multiple of period
+        self.Deadline = self.next_boundary() #time.monotonic() of the next tick
+        self.Ticks = 0 #number of ticks run
+        self.Missed = 0 #number of deadlines skipped because a tick overran
+        self.Overruns = [] #(wall-clock deadline, seconds late) for every overrun and every tick that started more than late_tolerance late
+        self.Lateness = 0 #number of seconds the last tick started after its deadline
+
+    def next_boundary(self): #time.monotonic() of the next wall-clock boundary
+        return time.monotonic() + self.period - ((time.time() - self.offset) % self.period)
+
+    def delay(self): #number of seconds until the next tick, skips the deadlines an overrun has already missed
+        now = time.monotonic()
+        late = now - self.Deadline
+        if late > late_tolerance:
+            missed = int(late // self.period) + 1
+            deadline = datetime.datetime.fromtimestamp(time.time() - late)
+            self.Missed += missed
+            self.Overruns.append((deadline, late))
+            print(f"Tick due at {deadline} overran by {round(late, 3)} seconds, skipping {missed} tick(s)")
+            self.Deadline = self.next_boundary()
+        return max(0, self.Deadline - now)
+
+    def tick(self): #start the tick that was due, returns its wall-clock deadline
+        self.Lateness = max(0, time.monotonic() - self.Deadline)
+        scheduled = time.time() - self.Lateness
+        if self.Lateness > late_tolerance: #the caller stalled between delay() and now, e.g. a blocking call on an event loop
+            self.Overruns.append((datetime.datetime.fromtimestamp(scheduled), self.Lateness))
+            print(f"Tick due at {datetime.datetime.fromtimestamp(scheduled)} started {round(self.Lateness, 3)} seconds late")
+        self.Ticks += 1
+        error = (scheduled - self.offset + self.period / 2) % self.period - self.period / 2 #distance from the nearest wall-clock boundary
+        if abs(error) > drift_tolerance: #wall clock was stepped (e.g. by NTP), count this tick as the nearest boundary's and line up the rest
+            print(f"Wall clock moved {round(error, 3)} seconds from the tick boundary, realigning")
+            scheduled -= error
+            self.Deadline = time.monotonic() + scheduled + self.period - time.time()
+        else:
+            self.Deadline += self.period
+        return datetime.datetime.fromtimestamp(scheduled)
+
+    def wait(self): #sleep until the next tick and start it
+        time.sleep(self.delay())
+        return self.tick()
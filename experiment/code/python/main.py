@@ -1,13 +1,32 @@
 import MHWsim as sim
+import MHWasync
 import Alert
+import signal
+import sys
 import time
 
+use_asyncio = False #run the single event loop engine in MHWasync instead of MHWsim
+restart_wait = 5 #number of seconds to wait before starting the program over, the checkpoint lets it carry on where it stopped
+alert_wait = 5*60 #number of seconds between emails while the program keeps crashing
+
+def stop(signum, frame): #a service stop (SIGTERM) unwinds through the finally blocks, so the heaters go off and buffered rows are written
+    sys.exit(0)
+
 if __name__ == "__main__":
+    signal.signal(signal.SIGTERM, stop)
+    last_alert = None
     while True: #restart program if it breaks
         try:
-            sim.mhw_sim()
+            if use_asyncio:
+                MHWasync.mhw_sim()
+            else:
+                sim.mhw_sim()
             break #stop the program once everything has run
+        except SystemExit:
+            raise
         except:
-            Alert.send_email() #email amelia
+            if last_alert is None or time.monotonic() - last_alert > alert_wait: #one email per crash loop, not one per restart
+                Alert.send_email() #email amelia
+                last_alert = time.monotonic()
             print("there's an issue!")
-            time.sleep(2*60) #wait 2 minutes before starting the program over
+            time.sleep(restart_wait) #wait before starting the program over